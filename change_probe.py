@@ -0,0 +1,83 @@
+import hashlib
+import logging
+
+from config import PROBE_FAILED_GAMES
+from game_api import game_api
+from snapshot import parse_snapshot
+
+
+PROBE_WAIT = "WAIT"
+PROBE_REFRESH = "REFRESH"
+
+
+class ProbedGame:
+    def __init__(self):
+        self.status = None
+        self.etag = None
+        self.digest = None
+        self.no_probe = False  # the probe failed for this game, e.g. the server does not know it
+
+
+class ChangeProbe:
+    """
+    Tells whether a game has advanced before paying for the full spectator reply.
+    First asks the server's lightweight waitingfor endpoint with the last seen game age,
+    then falls back to a conditional request and to hashing the raw payload, so that
+    an unchanged game is never decoded twice.
+    """
+
+    def __init__(self):
+        self.games = {}  # (host, game_id) -> ProbedGame
+        self.no_probe_hosts = set()  # servers without waitingfor support for spectators
+        self.failed = {}  # host -> ids of games whose probe failed since the last successful probe on the host
+
+    async def fetch(self, host, game_id):
+        """ returns (snapshot, changed), snapshot is the cached one if the game has not changed """
+        game = self.games.setdefault((host, game_id), ProbedGame())
+        if game.status is not None and not game.no_probe and host not in self.no_probe_hosts:
+            result = await self.probe(host, game_id, game)
+            if result == PROBE_WAIT:
+                return game.status, False
+        headers = {'If-None-Match': game.etag} if game.etag else None
+        reply = await game_api.get(host, "spectator", {'id': game_id}, headers=headers)
+        if reply.status_code == 304 and game.status is not None:
+            return game.status, False
+        reply.raise_for_status()
+        digest = hashlib.blake2b(reply.content, digest_size=16).digest()
+        if digest == game.digest:
+            return game.status, False
+        status = parse_snapshot(reply.content)
+        game.status = status
+        game.digest = digest
+        game.etag = reply.headers.get('ETag')
+        return status, True
+
+    async def probe(self, host, game_id, game: ProbedGame):
+        if game.status.game_age is None:
+            return None
+        reply = await game_api.get(host, "waitingfor", {
+            'id': game_id,
+            'gameAge': game.status.game_age,
+            'undoCount': game.status.undo_count or 0,
+        })
+        if reply.is_server_error:
+            reply.raise_for_status()
+        try:
+            reply.raise_for_status()
+            result = reply.json()['result']
+            assert result in (PROBE_WAIT, PROBE_REFRESH)
+        except Exception:
+            # one unknown or deleted game says nothing about the server, only failures in several games do
+            game.no_probe = True
+            failed = self.failed.setdefault(host, set())
+            failed.add(game_id)
+            if len(failed) >= PROBE_FAILED_GAMES:
+                logging.info("Server %s does not support change probes, falling back to full fetches", host)
+                self.no_probe_hosts.add(host)
+                del self.failed[host]
+            return None
+        self.failed.pop(host, None)
+        return result
+
+    def forget(self, host, game_id):
+        self.games.pop((host, game_id), None)
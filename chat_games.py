@@ -0,0 +1,110 @@
+import itertools
+
+from constants import ST_FINISHED
+from game_data import GameData, Player
+
+
+class ChatGames:
+    """
+    The games a chat tracks, by label, with an index of the games every telegram user and
+    in-game name plays in, so commands find their game without looking through all of them.
+    """
+    __slots__ = ('games', 'by_username', 'by_name', 'waiting', 'cold')
+
+    def __init__(self):
+        self.games = {}  # label -> GameData
+        self.by_username = {}  # tg username -> {label: GameData}
+        self.by_name = {}  # in-game name -> {label: GameData}
+        self.waiting = False  # the next spectator link sent to the chat starts tracking a game
+        self.cold = set()  # labels of games moved to cold storage, see SqlitePersistence.freeze
+
+    def __len__(self):
+        return len(self.games)
+
+    def __iter__(self):
+        return iter(self.games.values())
+
+    def get(self, label) -> GameData:
+        return self.games.get(label)
+
+    def find(self, host, game_id) -> GameData:
+        return next((data for data in self.games.values() if (data.host, data.game_id) == (host, game_id)), None)
+
+    def active(self):
+        return [data for data in self.games.values() if data.state != ST_FINISHED]
+
+    def add(self, data: GameData, label=None):
+        """ adds the game under the label, the given one, its own or the first free number """
+        label = label or data.label or next(str(n) for n in itertools.count(1)
+                                            if str(n) not in self.games and str(n) not in self.cold)
+        if label in self.games:
+            self.remove(label)
+        self.cold.discard(label)
+        data.label = label
+        self.games[label] = data
+        for username in data.players:
+            self.by_username.setdefault(username, {})[label] = data
+        for name in self.names(data):
+            self.by_name.setdefault(name, {})[label] = data
+        return data
+
+    def remove(self, label) -> GameData:
+        data = self.games.pop(label)
+        for username in data.players:
+            self.unindex(self.by_username, username, label)
+        for name in self.names(data):
+            self.unindex(self.by_name, name, label)
+        return data
+
+    def freeze(self, label) -> GameData:
+        """ forgets the game, only its label stays to bring it back from cold storage """
+        self.cold.add(label)
+        return self.remove(label)
+
+    @staticmethod
+    def names(data: GameData):
+        return set(data.player_names).union(p.name for p in data.players.values() if p.name)
+
+    @staticmethod
+    def unindex(index, key, label):
+        games = index.get(key)
+        if games is not None:
+            games.pop(label, None)
+            if not games:
+                del index[key]
+
+    def of_user(self, username):
+        return list(self.by_username.get(username, {}).values())
+
+    def of_name(self, name):
+        return list(self.by_name.get(name, {}).values())
+
+    def set_player(self, data: GameData, username, name, player_id=None) -> Player:
+        player = data.set_player(username, name, player_id)
+        self.by_username.setdefault(username, {})[data.label] = data
+        self.by_name.setdefault(name, {})[data.label] = data
+        return player
+
+    def note_names(self, data: GameData, names):
+        """ indexes the in-game names as the server reports them """
+        if names == data.player_names:
+            return
+        for name in set(data.player_names).difference(names):
+            if data.player_by_name(name) is None:
+                self.unindex(self.by_name, name, data.label)
+        for name in names:
+            self.by_name.setdefault(name, {})[data.label] = data
+        data.player_names = tuple(names)
+
+    def to_dict(self):
+        return {'games': [data.to_dict() for data in self.games.values()], 'waiting': self.waiting,
+                'cold': sorted(self.cold)}
+
+    @classmethod
+    def from_dict(cls, d):
+        games = cls()
+        for data in d['games']:
+            games.add(GameData.from_dict(data))
+        games.waiting = d['waiting']
+        games.cold = set(d.get('cold', ()))
+        return games
@@ -0,0 +1,46 @@
+import asyncio
+import sys
+import weakref
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+_locks = weakref.WeakValueDictionary()  # chat_id -> asyncio.Lock, dropped when nobody holds or awaits it
+
+
+def chat_lock(chat_id) -> asyncio.Lock:
+    """ serializes everything that mutates one chat's data: its updates, poller fan-out and passes """
+    lock = _locks.get(chat_id)
+    if lock is None:
+        lock = _locks[chat_id] = asyncio.Lock()
+    return lock
+
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different chats concurrently, while updates of the same chat
+    are handled one by one in the order they came. At most max_concurrent_updates are handled
+    at once; updates waiting for their chat do not count, so a slow chat does not hold up the others.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        # the base class limit is taken before do_process_update, i.e. also by updates waiting for their chat
+        super().__init__(sys.maxsize)
+        self.limit = asyncio.Semaphore(max_concurrent_updates)
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self.limit:
+                await coroutine
+            return
+        async with chat_lock(chat.id):
+            async with self.limit:
+                await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
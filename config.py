@@ -1,12 +1,56 @@
-from constants import LANG_RU
+from constants import LANG_RU, RUN_POLLING
 
 
 TOKEN = "<your token here>"
+RUN_MODE = RUN_POLLING  # or RUN_WEBHOOK
 LOG_NAME = "main.log"
+PERSISTENCE_FILE = "persistence.sqlite3"
+LEGACY_PERSISTENCE_FILE = "persistence.pickle"
 
 DEFAULT_HOST = "158.160.14.10:8080"
 
 DEFAULT_DELAY = 5  # minutes
 UPDATE_FREQUENCY = 15  # seconds
+POLL_TICK = 1  # seconds
+POLL_MIN_INTERVAL = 5  # seconds
+POLL_MAX_INTERVAL = 120  # seconds
+POLL_JITTER = 0.1  # fraction of the poll interval
+PASS_CHECK_FREQUENCY = 3  # seconds
+RESUME_BATCH = 500  # chats resumed on start between yields to the event loop
 DEFAULT_LANG = LANG_RU
 MESSAGE_HISTORY = 3
+SWEEP_FREQUENCY = 10 * 60  # seconds, must be well below MESSAGE_DELETE_TIMEOUT
+RECORD_HISTORY = False  # append every change of tracked games to HISTORY_DIR, see recorder.py
+HISTORY_DIR = "history"
+HISTORY_FLUSH_FREQUENCY = 60  # seconds
+DIGEST_FREQUENCY = 60  # seconds between updates of /digest messages
+COLD_AFTER = 7 * 24 * 60 * 60  # seconds without a new turn before a game goes to cold storage, finished ones go at once
+EVICT_FREQUENCY = 10 * 60  # seconds
+
+GAME_SERVER_CONNECT_TIMEOUT = 5  # seconds
+GAME_SERVER_READ_TIMEOUT = 10  # seconds
+GAME_SERVER_MAX_CONNECTIONS = 10  # per host
+TABLES_PARALLELISM = 4  # games created at once by /tables
+CIRCUIT_FAILURES = 5  # consecutive failed requests before a host is given a rest
+CIRCUIT_RESET_TIMEOUT = 60  # seconds before a resting host is tried again
+PROBE_FAILED_GAMES = 3  # games with failed change probes before a host is taken for not supporting them
+
+TG_GLOBAL_RATE = 25  # messages per second
+TG_GLOBAL_BURST = 30
+TG_CHAT_RATE = 20 / 60  # messages per second
+TG_CHAT_BURST = 3
+
+METRICS_ENABLED = False
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
+ADMIN_IDS = []  # telegram user ids allowed to use /stats
+
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_URL = ""  # public url to register with setWebhook, leave empty to skip registration
+WEBHOOK_SECRET = "<your secret here>"
+UPDATE_QUEUE_SIZE = 1000
+MAX_CONCURRENT_UPDATES = 64  # updates of one chat are still handled in order
+
+SHARDS = 0  # worker processes splitting tracked games between them, 0 runs everything in one process
@@ -1,10 +1,16 @@
 ST_WAIT_GAME_ID = "wait_id"
 ST_TRACKING = "tracking"
 ST_PAUSED = "paused"
+ST_FINISHED = "finished"
 PHASE_DRAFTING = "drafting"
 PHASE_RESEARCH = "research"
+PHASE_END = "end"
 TURN_PASS = "pass"
 LANG_EN = "en"
 LANG_RU = "ru"
+RUN_POLLING = "polling"
+RUN_WEBHOOK = "webhook"
+FLEET_TURNS = "fleet_turns"  # name of the saved turn statistics of all games
 
 MESSAGE_DELETE_TIMEOUT = 48 * 60 * 60   # 48 hours
+MAX_MESSAGE_LENGTH = 4096
@@ -0,0 +1,157 @@
+from typing import NamedTuple
+
+from game_data import GameData
+
+
+class DigestEntry(NamedTuple):
+    """ a game where it is the user's turn """
+    title: str
+    phase: str
+    started: int  # unix time, s
+    host: str
+    player_id: str
+
+
+class DigestUser:
+    """ a user who gets the digest instead of pings, kept in the chat_data of their private chat """
+    __slots__ = ('user_id', 'username', 'message_id', 'text', 'turns', 'chats', 'notify')
+
+    def __init__(self, user_id, username, message_id=None, text=None):
+        self.user_id = user_id  # also the id of the private chat
+        self.username = username
+        self.message_id = message_id  # the digest message, edited while there is something to show
+        self.text = text  # as last sent
+        self.turns = {}  # (host, game_id) -> DigestEntry, once however many chats track the game
+        self.chats = {}  # (host, game_id) -> ids of the chats tracking the game where it is the user's turn
+        self.notify = False  # send a new message instead of a silent edit
+
+    def to_dict(self):
+        return {'user_id': self.user_id, 'username': self.username, 'message_id': self.message_id, 'text': self.text}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['user_id'], d['username'], d['message_id'], d['text'])
+
+
+class Digest:
+    """
+    Index of the games where it is the turn of users who opted in for the digest, across all chats.
+    Turn changes only update the index; the digest job then edits one message per user whose games
+    changed, and sends a new one only when a user with nothing to do gets a turn, so a player
+    in many games costs a Telegram request per job run instead of a ping per game.
+    With shards, the digest of a user is kept by the shard of their private chat; the other shards
+    know the user as remote and forward the user's turns in their games there.
+    """
+
+    def __init__(self):
+        self.users = {}  # tg username -> DigestUser
+        self.remote = {}  # tg username -> user id, subscribers whose digest another shard keeps
+        self.games = {}  # (chat_id, host, game_id) -> {tg username: DigestEntry} of subscribers on turn there
+        self.seen = {}  # (chat_id, host, game_id) -> (GameData, phase, current players) while someone is on turn
+        self.dirty = set()  # usernames whose message is outdated
+        self.forward = None  # (user_id, username, key, DigestEntry or None) -> None, sends a remote user's turn
+        self.announce = None  # (username, user_id or None if unsubscribed) -> None, tells the other shards
+
+    def subscribe(self, user: DigestUser):
+        self.users[user.username] = user
+        self.remote.pop(user.username, None)
+        self.dirty.add(user.username)
+        if self.announce:
+            self.announce(user.username, user.user_id)
+        self.drop_turns(user.username)
+        self.refresh()
+
+    def subscribe_remote(self, username, user_id):
+        """ another shard keeps the user's digest, or no longer does if user_id is None """
+        if username in self.users:
+            return
+        self.drop_turns(username)
+        if user_id is None:
+            self.remote.pop(username, None)
+        else:
+            self.remote[username] = user_id
+            self.refresh()
+
+    def drop_turns(self, username):
+        """ forgets the games the user was seen on turn in, the next update of each puts the user in again """
+        for key in [key for key, on_turn in self.games.items() if username in on_turn]:
+            on_turn = self.games[key]
+            del on_turn[username]
+            if not on_turn:
+                del self.games[key]
+
+    def refresh(self):
+        """ puts the turns a new subscriber already has in their digest """
+        for (chat_id, _, _), (data, phase, players) in list(self.seen.items()):
+            self.update(chat_id, data, phase, players)
+
+    def unsubscribe(self, username, announce=True):
+        user = self.users.pop(username, None)
+        self.dirty.discard(username)
+        self.drop_turns(username)
+        if announce and self.announce:
+            self.announce(username, None)
+        return user
+
+    def covers(self, data: GameData, player_name):
+        """ whether the player gets the digest instead of pings """
+        player = data.player_by_name(player_name)
+        return player is not None and (player.username in self.users or player.username in self.remote)
+
+    def update(self, chat_id, data: GameData, phase, players):
+        """ puts the game in the digests of the subscribed current players and drops it from the others """
+        key = (chat_id, data.host, data.game_id)
+        on_turn = {}
+        if players:
+            self.seen[key] = (data, phase, players)
+        else:
+            self.seen.pop(key, None)
+        if self.users or self.remote:
+            for name, started in players:
+                player = data.player_by_name(name)
+                if player is not None and (player.username in self.users or player.username in self.remote):
+                    on_turn[player.username] = DigestEntry(data.label or data.game_id, phase, started // 1000,
+                                                           data.host, player.player_id)
+        before = self.games.pop(key, {})
+        for username in before.keys() - on_turn.keys():
+            self.set_turn(username, key, None)
+        for username, entry in on_turn.items():
+            if before.get(username) != entry:
+                self.set_turn(username, key, entry)
+        if on_turn:
+            self.games[key] = on_turn
+
+    def set_turn(self, username, key, entry):
+        """ the user's turn in the game of the chat started, or is over if entry is None """
+        user = self.users.get(username)
+        if user is None:
+            if username in self.remote and self.forward:
+                self.forward(self.remote[username], username, key, entry)
+            return
+        chat_id, game = key[0], key[1:]
+        chat_ids = user.chats.setdefault(game, set())
+        if entry is None:
+            chat_ids.discard(chat_id)
+            if not chat_ids:
+                del user.chats[game]
+                if user.turns.pop(game, None):
+                    self.dirty.add(username)
+            return
+        chat_ids.add(chat_id)
+        old = user.turns.get(game)
+        # the chats may name the game differently, the first one's name stays
+        if old is not None and old[1:] == entry[1:]:
+            return
+        if not user.turns:
+            user.notify = True
+        user.turns[game] = entry._replace(title=old.title) if old else entry
+        self.dirty.add(username)
+
+    def forget(self, chat_id, data: GameData):
+        self.update(chat_id, data, None, ())
+
+    def pop_dirty(self):
+        """ returns the users whose digest is to be updated """
+        users = [self.users[username] for username in self.dirty if username in self.users]
+        self.dirty.clear()
+        return users
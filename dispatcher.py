@@ -0,0 +1,216 @@
+import asyncio
+import datetime as dt
+import heapq
+import itertools
+import logging
+import time
+
+from telegram import Bot
+from telegram.error import RetryAfter, TelegramError
+
+import metrics
+from config import TG_GLOBAL_RATE, TG_GLOBAL_BURST, TG_CHAT_RATE, TG_CHAT_BURST
+
+
+PRIORITY_PING = 0
+PRIORITY_STATUS = 1
+PRIORITY_DELETE = 2
+
+MAX_DELETE_BATCH = 100  # Bot API limit for deleteMessages
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        self.refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class OutgoingMessage:
+    def __init__(self, chat_id, priority, text=None, on_sent=None, kwargs=None, edited_id=None, on_failed=None,
+                 ping_key=None):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.text = text
+        self.on_sent = on_sent
+        self.kwargs = kwargs or {}
+        self.message_ids = []  # for deletions
+        self.edited_id = edited_id  # the message to edit instead of sending a new one
+        self.on_failed = on_failed  # (TelegramError) -> None
+        self.ping_key = ping_key  # what the ping is about, see MessageDispatcher.ping
+
+
+class MessageDispatcher:
+    """
+    Outbound queue for messages sent outside of command handlers. Callers only enqueue;
+    a single worker sends messages by priority (pings, then status updates, then deletions)
+    within global and per-chat rate limits, replaces a chat's unsent ping or message edit with
+    a newer one and deletes old messages in bulk.
+    """
+
+    def __init__(self):
+        self.queues = {}  # chat_id -> heap of (priority, seq, OutgoingMessage)
+        self.pings = {}  # (chat_id, key) -> unsent ping
+        self.deletions = {}  # chat_id -> unsent deletion
+        self.edits = {}  # (chat_id, message_id) -> unsent edit
+        self.global_bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_BURST)
+        self.chat_buckets = {}
+        self.seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.paused_until = 0
+        self.bot = None
+        self.task = None
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        self.task = asyncio.create_task(self.run(), name="message dispatcher")
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def push(self, item: OutgoingMessage):
+        heapq.heappush(self.queues.setdefault(item.chat_id, []), (item.priority, next(self.seq), item))
+        self.wakeup.set()
+
+    def send(self, chat_id, text, priority=PRIORITY_STATUS, on_sent=None, on_failed=None, **kwargs):
+        """ on_sent(message) is called once the message is sent, on_failed(error) if Telegram refused it """
+        self.push(OutgoingMessage(chat_id, priority, text, on_sent, kwargs, on_failed=on_failed))
+
+    def ping(self, chat_id, text, on_sent=None, key=None, **kwargs):
+        """
+        like send(), but an unsent ping with the same key in the chat, e.g. about the same game,
+        is replaced instead of sending both
+        """
+        item = self.pings.get((chat_id, key))
+        if item:
+            item.text, item.on_sent, item.kwargs = text, on_sent, kwargs
+            return
+        item = self.pings[(chat_id, key)] = OutgoingMessage(chat_id, PRIORITY_PING, text, on_sent, kwargs,
+                                                            ping_key=key)
+        self.push(item)
+
+    def edit(self, chat_id, message_id, text, on_failed=None, **kwargs):
+        """ replaces the text of a sent message, an unsent edit of the same message is replaced too """
+        item = self.edits.get((chat_id, message_id))
+        if item:
+            item.text, item.on_failed, item.kwargs = text, on_failed, kwargs
+            return
+        item = self.edits[(chat_id, message_id)] = OutgoingMessage(chat_id, PRIORITY_STATUS, text, kwargs=kwargs,
+                                                                   edited_id=message_id, on_failed=on_failed)
+        self.push(item)
+
+    def delete(self, chat_id, message_ids):
+        item = self.deletions.get(chat_id)
+        if item is None:
+            item = self.deletions[chat_id] = OutgoingMessage(chat_id, PRIORITY_DELETE)
+            self.push(item)
+        item.message_ids.extend(message_ids)
+
+    def next_item(self, now):
+        """ returns the most urgent item allowed to go now, or the time to wait for one """
+        best = None
+        wait = None
+        for chat_id, queue in self.queues.items():
+            bucket = self.chat_buckets.get(chat_id)
+            chat_wait = bucket.wait_time(now) if bucket else 0
+            if chat_wait > 0:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+            elif best is None or queue[0] < best:
+                best = queue[0]
+        return best[2] if best else None, wait
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            wait = max(self.paused_until - now, self.global_bucket.wait_time(now))
+            item = None
+            if wait <= 0:
+                item, wait = self.next_item(now)
+            if item is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.pop(item)
+            self.global_bucket.take()
+            self.chat_buckets.setdefault(item.chat_id, TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)).take()
+            await self.deliver(item)
+
+    def pop(self, item: OutgoingMessage):
+        queue = self.queues[item.chat_id]
+        heapq.heappop(queue)
+        if not queue:
+            self.queues.pop(item.chat_id)
+        if item.priority == PRIORITY_PING and self.pings.get((item.chat_id, item.ping_key)) is item:
+            self.pings.pop((item.chat_id, item.ping_key))
+        if self.deletions.get(item.chat_id) is item:
+            self.deletions.pop(item.chat_id)
+        if item.edited_id is not None and self.edits.get((item.chat_id, item.edited_id)) is item:
+            self.edits.pop((item.chat_id, item.edited_id))
+
+    async def deliver(self, item: OutgoingMessage):
+        if item.priority == PRIORITY_DELETE:
+            method = 'deleteMessages'
+        elif item.edited_id is not None:
+            method = 'editMessageText'
+        else:
+            method = 'sendMessage'
+        try:
+            with metrics.timed('telegram_request_seconds', method=method):
+                if item.priority == PRIORITY_DELETE:
+                    rest = item.message_ids[MAX_DELETE_BATCH:]
+                    item.message_ids = item.message_ids[:MAX_DELETE_BATCH]
+                    if rest:
+                        self.delete(item.chat_id, rest)
+                    await self.bot.delete_messages(chat_id=item.chat_id, message_ids=item.message_ids)
+                    return
+                if item.edited_id is not None:
+                    await self.bot.edit_message_text(item.text, chat_id=item.chat_id, message_id=item.edited_id,
+                                                     **item.kwargs)
+                    return
+                msg = await self.bot.send_message(chat_id=item.chat_id, text=item.text, **item.kwargs)
+            if item.on_sent:
+                item.on_sent(msg)
+        except RetryAfter as e:
+            metrics.inc('telegram_errors_total', method=method, error='RetryAfter')
+            delay = e.retry_after
+            if isinstance(delay, dt.timedelta):
+                delay = delay.total_seconds()
+            logging.warning("Flood limit hit, pausing outgoing messages for %s s", delay)
+            self.paused_until = time.monotonic() + delay
+            if item.priority == PRIORITY_DELETE:
+                self.delete(item.chat_id, item.message_ids)
+            elif item.priority == PRIORITY_PING:
+                if (item.chat_id, item.ping_key) not in self.pings:
+                    self.pings[(item.chat_id, item.ping_key)] = item
+                    self.push(item)
+            elif item.edited_id is not None:
+                if (item.chat_id, item.edited_id) not in self.edits:
+                    self.edits[(item.chat_id, item.edited_id)] = item
+                    self.push(item)
+            else:
+                self.push(item)
+        except TelegramError as e:
+            metrics.inc('telegram_errors_total', method=method, error=type(e).__name__)
+            if item.on_failed:
+                item.on_failed(e)
+            else:
+                logging.exception("Failed to deliver message to chat %s", item.chat_id)
+        except Exception:
+            logging.exception("Failed to handle sent message in chat %s", item.chat_id)
@@ -0,0 +1,139 @@
+import logging
+import time
+
+import httpx
+
+import metrics
+from config import (GAME_SERVER_CONNECT_TIMEOUT, GAME_SERVER_READ_TIMEOUT, GAME_SERVER_MAX_CONNECTIONS,
+                    CIRCUIT_FAILURES, CIRCUIT_RESET_TIMEOUT)
+
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(Exception):
+    """ the host keeps failing and is not called until its reset timeout passes """
+
+
+class HostHealth:
+    def __init__(self):
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0  # consecutive
+        self.opened_at = None
+        self.probing = False
+
+    def before_request(self):
+        if self.state == CIRCUIT_OPEN and time.monotonic() - self.opened_at >= CIRCUIT_RESET_TIMEOUT:
+            self.state = CIRCUIT_HALF_OPEN
+        if self.state == CIRCUIT_OPEN or (self.state == CIRCUIT_HALF_OPEN and self.probing):
+            raise CircuitOpenError()
+        if self.state == CIRCUIT_HALF_OPEN:
+            # a single request checks whether the host is back
+            self.probing = True
+
+    def on_success(self):
+        """ returns True if the host has recovered """
+        recovered = self.state != CIRCUIT_CLOSED
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.probing = False
+        return recovered
+
+    def on_failure(self):
+        """ returns True if the host has just gone down """
+        self.failures += 1
+        self.probing = False
+        if self.state == CIRCUIT_HALF_OPEN or self.failures >= CIRCUIT_FAILURES:
+            went_down = self.state == CIRCUIT_CLOSED
+            self.state = CIRCUIT_OPEN
+            self.opened_at = time.monotonic()
+            return went_down
+        return False
+
+
+class GameApiClient:
+    """
+    async client for game servers, keeps one pooled keep-alive session per host, which also bounds
+    the number of requests in flight. Requests to a host failing CIRCUIT_FAILURES times in a row
+    fail fast with CircuitOpenError until a single probe request after CIRCUIT_RESET_TIMEOUT succeeds.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.health = {}  # host -> HostHealth
+        self.on_host_state = None  # (host, available) -> None, called when a host goes down or recovers
+
+    def session(self, host) -> httpx.AsyncClient:
+        client = self.sessions.get(host)
+        if client is None:
+            client = self.sessions[host] = httpx.AsyncClient(
+                base_url=f"http://{host}",
+                timeout=httpx.Timeout(GAME_SERVER_READ_TIMEOUT, connect=GAME_SERVER_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=GAME_SERVER_MAX_CONNECTIONS,
+                                    max_keepalive_connections=GAME_SERVER_MAX_CONNECTIONS),
+            )
+        return client
+
+    async def request(self, host, method, path, **kwargs) -> httpx.Response:
+        health = self.health.get(host)
+        if health is None:
+            health = self.health[host] = HostHealth()
+        try:
+            health.before_request()
+        except CircuitOpenError:
+            metrics.inc('game_server_rejected_total', host=host)
+            raise
+        with metrics.timed('game_server_request_seconds', host=host, endpoint=path):
+            try:
+                reply = await self.session(host).request(method, path, **kwargs)
+            except httpx.HTTPError:
+                metrics.inc('game_server_errors_total', host=host, endpoint=path)
+                self.on_failure(host, health)
+                raise
+            except BaseException:
+                health.probing = False
+                raise
+        if reply.is_server_error:
+            self.on_failure(host, health)
+        elif health.on_success():
+            logging.warning("Game server %s is back", host)
+            self.notify(host, True)
+        return reply
+
+    def on_failure(self, host, health: HostHealth):
+        if health.on_failure():
+            logging.warning("Game server %s failed %d times in a row, pausing requests to it", host, health.failures)
+            self.notify(host, False)
+
+    def notify(self, host, available):
+        if self.on_host_state:
+            try:
+                self.on_host_state(host, available)
+            except Exception:
+                logging.exception("Failed to report state of game server %s", host)
+
+    async def get(self, host, page, params, headers=None) -> httpx.Response:
+        return await self.request(host, "GET", f"/api/{page}", params=params, headers=headers)
+
+    async def get_json(self, host, page, id):
+        reply = await self.get(host, page, {'id': id})
+        reply.raise_for_status()
+        return reply.json()
+
+    async def post_input(self, host, player_id, payload) -> httpx.Response:
+        return await self.request(host, "POST", "/player/input", params={'id': player_id}, json=payload)
+
+    async def create_game(self, host, params):
+        reply = await self.request(host, "PUT", "/game", json=params)
+        reply.raise_for_status()
+        return reply
+
+    async def close(self):
+        sessions, self.sessions = self.sessions, {}
+        for client in sessions.values():
+            await client.aclose()
+
+
+game_api = GameApiClient()
@@ -1,30 +1,207 @@
+from collections import deque
+
 from config import DEFAULT_DELAY
 from tf_tracker import TerraformingTracker
+from turn_stats import TurnStats
+
+
+GAME_DATA_VERSION = 6
+
+
+class Player:
+    """ a chat member known to the bot, by telegram username and in-game name """
+    __slots__ = ('username', 'name', 'player_id', 'tagged', 'action')
+
+    def __init__(self, username, name=None, player_id=None, tagged=False, action=None):
+        self.username = username
+        self.name = name
+        self.player_id = player_id
+        self.tagged = tagged  # address by @username in pings
+        self.action = action  # scheduled turn, e.g. TURN_PASS
+
+    def to_list(self):
+        return [self.username, self.name, self.player_id, self.tagged, self.action]
+
+    @classmethod
+    def from_list(cls, values):
+        return cls(*values)
+
+    def __repr__(self):
+        return f"Player({', '.join(map(repr, self.to_list()))})"
 
 
 class GameData:
+    __slots__ = ('state', 'host', 'game_id', 'last_ping', 'ping_delay_min', 'players', 'players_by_name',
+                 'message_ids_queue', 'tft', 'turn_stats', 'turn_players', 'label', 'player_names',
+                 'last_turn_at')
+
     def __init__(self, state, host=None, game_id=None, last_ping=None):
         self.state = state
         self.host = host
         self.game_id = game_id
         self.last_ping = last_ping
         self.ping_delay_min = DEFAULT_DELAY
-        self.users_tag = {}
-        self.users_info = {}  # keys are tg usernames
-        self.scheduled_turns = {}
-        self.message_ids_queue = []
+        self.players = {}  # tg username -> Player
+        self.players_by_name = {}  # in-game name -> Player
+        self.message_ids_queue = deque()  # (message_id, sent at), oldest first
         self.tft = TerraformingTracker()
+        self.turn_stats = TurnStats()
+        self.turn_players = ()  # current players of the action phase when last seen
+        self.label = None  # the game's name in its chat, shown in messages if the chat tracks several games
+        self.player_names = ()  # in-game names of all players as last seen
+        self.last_turn_at = None  # unix time the last seen turn started at
 
     def __str__(self):
         return f"GameData(state={self.state}, host={self.host}, game_id={self.game_id}, last_ping={self.last_ping}, " \
-               f"users_info={self.users_info}, scheduled_turns={self.scheduled_turns}"
+               f"players={list(self.players.values())}"
+
+    def player(self, username) -> Player:
+        return self.players.get(username)
+
+    def player_by_name(self, name) -> Player:
+        return self.players_by_name.get(name)
+
+    def set_player(self, username, name, player_id=None) -> Player:
+        """ creates or renames the user's player, keeping the known player id unless a new one is given """
+        player = self.players.get(username)
+        if player is None:
+            player = self.players[username] = Player(username)
+        if player.name != name:
+            if self.players_by_name.get(player.name) is player:
+                del self.players_by_name[player.name]
+            player.name = name
+            # one player per in-game name, the latest claim wins
+            previous = self.players_by_name.get(name)
+            if previous is not None:
+                previous.name = None
+            self.players_by_name[name] = player
+        if player_id is not None:
+            player.player_id = player_id
+        return player
+
+    def scheduled(self):
+        return [p for p in self.players.values() if p.action]
+
+    def clear_actions(self):
+        for player in self.players.values():
+            player.action = None
+
+    def to_dict(self):
+        return {
+            'version': GAME_DATA_VERSION,
+            'state': self.state,
+            'host': self.host,
+            'game_id': self.game_id,
+            'last_ping': self.last_ping,
+            'ping_delay_min': self.ping_delay_min,
+            'players': [p.to_list() for p in self.players.values()],
+            'message_ids_queue': list(self.message_ids_queue),
+            'tft_last': self.tft.last,
+            'turn_stats': self.turn_stats.to_dict(),
+            'turn_players': self.turn_players,
+            'label': self.label,
+            'player_names': self.player_names,
+            'last_turn_at': self.last_turn_at,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        version = d['version']
+        if version > GAME_DATA_VERSION:
+            raise ValueError("Unsupported GameData version {}".format(version))
+        while version < GAME_DATA_VERSION:
+            d = MIGRATIONS[version](d)
+            version = d['version']
+        last_ping = d['last_ping']
+        data = cls(d['state'], host=d['host'], game_id=d['game_id'],
+                   last_ping=tuple(map(tuple, last_ping)) if last_ping is not None else None)
+        data.ping_delay_min = d['ping_delay_min']
+        for values in d['players']:
+            player = Player.from_list(values)
+            data.players[player.username] = player
+            if player.name is not None:
+                data.players_by_name[player.name] = player
+        data.message_ids_queue = deque(tuple(m) for m in d['message_ids_queue'])
+        data.tft.last = d['tft_last']
+        data.turn_stats = TurnStats.from_dict(d['turn_stats'])
+        data.turn_players = tuple(map(tuple, d['turn_players']))
+        data.label = d['label']
+        data.player_names = tuple(d['player_names'])
+        data.last_turn_at = d['last_turn_at']
+        return data
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        if 'version' not in state:
+            # pickled before GameData had versions
+            state = from_legacy(state)
+        restored = self.from_dict(state)
+        for name in self.__slots__:
+            setattr(self, name, getattr(restored, name))
+
+
+def from_legacy(state):
+    """ attributes of a GameData pickled by the first versions of the bot as a version 1 dict """
+    tft = state.get('tft')
+    return {
+        'version': 1,
+        'state': state['state'],
+        'host': state.get('host'),
+        'game_id': state.get('game_id'),
+        'last_ping': state.get('last_ping'),
+        'ping_delay_min': state.get('ping_delay_min', DEFAULT_DELAY),
+        'users_tag': state.get('users_tag', {}),
+        'users_info': state.get('users_info', {}),
+        'scheduled_turns': state.get('scheduled_turns', {}),
+        # message ids without the time they were sent at are too old to delete anyway
+        'message_ids_queue': [m for m in state.get('message_ids_queue', []) if isinstance(m, (tuple, list))],
+        'tft_last': tft.last if tft is not None else 0,
+    }
+
+
+def migrate_v1(d):
+    """ users_info, users_tag and scheduled_turns are merged into one player table """
+    d = dict(d)
+    users_tag = d.pop('users_tag')
+    users_info = d.pop('users_info')
+    scheduled_turns = d.pop('scheduled_turns')
+    players = {username: [username, name, player_id, users_tag.get(name) == username, scheduled_turns.get(username)]
+               for username, (name, player_id) in users_info.items()}
+    for name, username in users_tag.items():
+        if username not in players:
+            players[username] = [username, name, None, True, None]
+    d['players'] = list(players.values())
+    d['version'] = 2
+    return d
+
+
+def migrate_v2(d):
+    """ turn time statistics start empty """
+    return dict(d, version=3, turn_stats={}, turn_players=[])
+
+
+def migrate_v3(d):
+    """ games get labels, the existing ones are the only game of their chat """
+    return dict(d, version=4, label=None)
+
+
+def migrate_v4(d):
+    """ player names are learnt from the next status """
+    return dict(d, version=5, player_names=[])
+
 
-    def restore(self):
-        """ for handling class structure updates during single game """
-        if not hasattr(self, 'scheduled_turns'):
-            self.scheduled_turns = {}
-        if not hasattr(self, 'message_ids_queue '):
-            self.message_ids_queue = []
-        return self
+def migrate_v5(d):
+    """ the time of the last turn is learnt from the next status """
+    return dict(d, version=6, last_turn_at=None)
 
 
+MIGRATIONS = {
+    # version -> function converting its dict to the next version
+    1: migrate_v1,
+    2: migrate_v2,
+    3: migrate_v3,
+    4: migrate_v4,
+    5: migrate_v5,
+}
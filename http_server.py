@@ -0,0 +1,64 @@
+import asyncio
+import logging
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qsl
+
+
+MAX_BODY = 1 << 20
+
+
+class Request:
+    def __init__(self, method, target, headers, body):
+        parsed = urlsplit(target)
+        self.method = method
+        self.path = parsed.path
+        self.query = dict(parse_qsl(parsed.query))
+        self.headers = headers  # lower-case names
+        self.body = body
+
+
+async def read_request(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        return None
+    method, target, _ = line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY:
+        raise ValueError("Request body too large")
+    body = await reader.readexactly(length) if length else b''
+    return Request(method, target, headers, body)
+
+
+async def serve(handler, host, port) -> asyncio.Server:
+    """
+    Minimal HTTP/1.1 server with keep-alive for local endpoints.
+    handler is async (Request) -> (status, content type, body bytes).
+    """
+    async def on_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while request := await read_request(reader):
+                try:
+                    status, content_type, body = await handler(request)
+                except Exception:
+                    logging.exception("Failed to handle %s %s", request.method, request.path)
+                    status, content_type, body = HTTPStatus.INTERNAL_SERVER_ERROR, 'text/plain', b''
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                writer.write(
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_connection, host, port)
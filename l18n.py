@@ -8,6 +8,9 @@ LK_BAD_GAME_ID = "bad_message_id"
 LK_WILL_PASS = "will_pass"
 LK_WILL_NOT_PASS = "will_not_pass"
 LK_TF_STATUS = "tf_status"
+LK_TF_VENUS = "tf_venus"
+LK_TF_MOON = "tf_moon"
+LK_TF_FORECAST = "tf_forecast"
 LK_PASSED = "passed"
 LK_START_GONE_WRONG = "start_gone_wrong"
 LK_PAUSE = "pause"
@@ -21,6 +24,20 @@ LK_START_COMMAND_ERROR = "start_command_error"
 LK_LANG_SWITCHED = "lang_switched"
 LK_SETLANG_COMMAND_ERROR = "setlang_command_error"
 LK_UNEXPECTED_MESSAGE = "unexpected_message"
+LK_SERVER_DOWN = "server_down"
+LK_SERVER_UP = "server_up"
+LK_TURN_STATS = "turn_stats"
+LK_TURN_STATS_ALL = "turn_stats_all"
+LK_NO_TURN_STATS = "no_turn_stats"
+LK_TURN_STATS_LINE = "turn_stats_line"
+LK_DIGEST_ON = "digest_on"
+LK_DIGEST_OFF = "digest_off"
+LK_DIGEST_PRIVATE = "digest_private"
+LK_DIGEST_NO_USERNAME = "digest_no_username"
+LK_DIGEST = "digest"
+LK_DIGEST_EMPTY = "digest_empty"
+LK_WHICH_GAME = "which_game"
+LK_STOPPED = "stopped"
 
 MESSAGES = {
     LK_WAIT_GAME_ID: {
@@ -43,6 +60,18 @@ MESSAGES = {
         LANG_RU: "*Марс терраформирован на {}%*: океанов {}, кислород {}%, температура {}",
         LANG_EN: "*Mars is terraformed by {}%*: {} oceans, {}% oxygen, temperature {}",
     },
+    LK_TF_VENUS: {
+        LANG_RU: ", Венера {}%",
+        LANG_EN: ", Venus {}%",
+    },
+    LK_TF_MOON: {
+        LANG_RU: ", Луна: колонии {}, добыча {}, логистика {}",
+        LANG_EN: ", Moon: habitat {}, mining {}, logistics {}",
+    },
+    LK_TF_FORECAST: {
+        LANG_RU: ". В таком темпе осталось поколений: {}",
+        LANG_EN: ". At this pace, generations left: {}",
+    },
     LK_PASSED: {
         LANG_RU: "Я спасовал за игрока ",
         LANG_EN: "I passed for player ",
@@ -94,6 +123,64 @@ MESSAGES = {
     LK_UNEXPECTED_MESSAGE: {
         LANG_RU: "Не знаю, что делать с этим сообщением. Возможно, игра не начата",
         LANG_EN: "I don't know what to do with this message, maybe you should start the game"
+    },
+    LK_SERVER_DOWN: {
+        LANG_RU: "Сервер игры {} не отвечает, проверю позже",
+        LANG_EN: "Game server {} is not responding, will check again later"
+    },
+    LK_SERVER_UP: {
+        LANG_RU: "Сервер игры {} снова доступен",
+        LANG_EN: "Game server {} is back"
+    },
+    LK_TURN_STATS: {
+        LANG_RU: "Время ходов в этой игре:",
+        LANG_EN: "Turn times in this game:"
+    },
+    LK_TURN_STATS_ALL: {
+        LANG_RU: "Во всех играх",
+        LANG_EN: "All games"
+    },
+    LK_NO_TURN_STATS: {
+        LANG_RU: "Пока не видел ни одного завершенного хода",
+        LANG_EN: "No finished turns seen yet"
+    },
+    LK_TURN_STATS_LINE: {
+        LANG_RU: "{}: ходов {}, в среднем {}, медиана {}, 90% ходов быстрее {}",
+        LANG_EN: "{}: {} turns, mean {}, median {}, 90% of turns under {}"
+    },
+    LK_DIGEST_ON: {
+        LANG_RU: "Ок, вместо уведомлений в чатах буду писать сюда, в каких играх ты ходишь. "
+                 "Список твоих текущих ходов появится в течение минуты, отключить: /digest",
+        LANG_EN: "Ok, instead of pinging you in the chats I will list here the games where it's your turn. "
+                 "Your current turns show up within a minute, turn it off with /digest"
+    },
+    LK_DIGEST_OFF: {
+        LANG_RU: "Хорошо, снова буду звать тебя в чатах игр",
+        LANG_EN: "Ok, I will ping you in the game chats again"
+    },
+    LK_DIGEST_PRIVATE: {
+        LANG_RU: "Напиши мне /digest в личные сообщения",
+        LANG_EN: "Send me /digest in a private message"
+    },
+    LK_DIGEST_NO_USERNAME: {
+        LANG_RU: "Сводка работает только для пользователей с @username",
+        LANG_EN: "The digest only works for users with a @username"
+    },
+    LK_DIGEST: {
+        LANG_RU: "Ждут твоего хода:",
+        LANG_EN: "Waiting for your turn:"
+    },
+    LK_DIGEST_EMPTY: {
+        LANG_RU: "Сейчас нигде не твой ход",
+        LANG_EN: "It's not your turn anywhere now"
+    },
+    LK_WHICH_GAME: {
+        LANG_RU: "В чате несколько игр, укажи игру первым аргументом команды: {}",
+        LANG_EN: "There are several games in the chat, give the game as the first argument: {}"
+    },
+    LK_STOPPED: {
+        LANG_RU: "Больше не слежу за игрой {}",
+        LANG_EN: "Not tracking game {} anymore"
     }
 }
 
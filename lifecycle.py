@@ -0,0 +1,21 @@
+from contextlib import asynccontextmanager
+
+from telegram.ext import Application
+
+
+@asynccontextmanager
+async def running(app: Application):
+    """ runs the application with its post_* hooks while updates come from somewhere else than its updater """
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    try:
+        yield app
+    finally:
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
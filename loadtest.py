@@ -0,0 +1,363 @@
+"""
+Load test: runs the real polling, auto-pass and game creation code against a local fake
+Terraforming Mars server and a fake Telegram Bot API, and reports throughput and latency.
+
+    python loadtest.py --games 10 100 1000 10000 --duration 60 --latency 0.05
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from http import HTTPStatus
+from urllib.parse import parse_qsl
+
+from http_server import Request, serve
+
+
+FAKE_HOST = "127.0.0.1"
+TOKEN = "123456:loadtest"
+
+
+class FakeGame:
+    def __init__(self, idx, num_players, turn_seconds, turns):
+        self.idx = idx
+        self.spectator_id = f"s{idx}"
+        self.names = [f"Player{idx}x{k}" for k in range(num_players)]
+        self.player_ids = [f"p{idx}x{k}" for k in range(num_players)]
+        self.turn_seconds = turn_seconds
+        self.turns_left = turns
+        self.phase = "action"
+        self.age = 0
+        self.current = 0
+        # spread turn changes of different games over the turn length
+        self.changed_at = time.time() - random.uniform(0, turn_seconds)
+        self.pinged_age = None
+
+    def update(self):
+        while self.phase != "end" and time.time() >= self.changed_at + self.turn_seconds:
+            self.advance(self.changed_at + self.turn_seconds)
+
+    def advance(self, at=None):
+        self.current = (self.current + 1) % len(self.names)
+        self.age += 1
+        self.changed_at = at or time.time()
+        self.turns_left -= 1
+        if self.turns_left <= 0:
+            self.phase = "end"
+
+    def spectator(self):
+        progress = min(self.age, 40) / 40
+        return {
+            'game': {
+                'phase': self.phase,
+                'gameAge': self.age,
+                'undoCount': 0,
+                'generation': 1 + self.age // len(self.names),
+                'oceans': round(9 * progress),
+                'oxygenLevel': round(14 * progress),
+                'temperature': -30 + 2 * round(19 * progress),
+            },
+            'players': [{
+                'name': name,
+                'timer': {'running': k == self.current and self.phase != "end",
+                          'startedAt': int(self.changed_at * 1000)},
+            } for k, name in enumerate(self.names)],
+        }
+
+    def player(self, k):
+        reply = {
+            'game': {'phase': self.phase, 'gameAge': self.age},
+            'thisPlayer': {'timer': {'running': k == self.current, 'startedAt': int(self.changed_at * 1000)}},
+        }
+        if k == self.current and self.phase != "end":
+            reply['waitingFor'] = {'options': [{'title': "Play project card"},
+                                               {'title': "Pass for this generation"}]}
+        return reply
+
+
+class FakeServers:
+    """ fake game server and fake Telegram Bot API, run in their own process """
+
+    def __init__(self, args):
+        self.args = args
+        self.games = {}
+        self.by_player = {}
+        self.counts = {}
+        self.ping_latencies = []
+        self.created = 0
+
+    def add_game(self, num_players):
+        game = FakeGame(len(self.games), num_players, self.args.turn_seconds, self.args.turns)
+        self.games[game.spectator_id] = game
+        for k, player_id in enumerate(game.player_ids):
+            self.by_player[player_id] = (game, k)
+        return game
+
+    def count(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    async def handle_game_api(self, request: Request):
+        await asyncio.sleep(self.args.latency)
+        self.count(f"{request.method} {request.path}")
+        if request.path == '/api/spectator':
+            game = self.games[request.query['id']]
+            game.update()
+            return HTTPStatus.OK, 'application/json', json.dumps(game.spectator()).encode()
+        if request.path == '/api/waitingfor':
+            game = self.games[request.query['id']]
+            game.update()
+            result = "REFRESH" if int(request.query['gameAge']) < game.age else "WAIT"
+            return HTTPStatus.OK, 'application/json', json.dumps({'result': result}).encode()
+        if request.path == '/api/player':
+            game, k = self.by_player[request.query['id']]
+            game.update()
+            return HTTPStatus.OK, 'application/json', json.dumps(game.player(k)).encode()
+        if request.path == '/player/input':
+            game, k = self.by_player[request.query['id']]
+            game.update()
+            if k != game.current or json.loads(request.body)['index'] != 1:
+                return HTTPStatus.BAD_REQUEST, 'application/json', b'{}'
+            game.advance()
+            self.count("passes")
+            return HTTPStatus.OK, 'application/json', b'{}'
+        if request.path == '/game' and request.method == 'PUT':
+            params = json.loads(request.body)
+            game = self.add_game(len(params['players']))
+            self.created += 1
+            return HTTPStatus.OK, 'application/json', json.dumps({
+                'id': f"g{game.idx}",
+                'spectatorId': game.spectator_id,
+                'players': [{'name': n, 'id': i} for n, i in zip(game.names, game.player_ids)],
+            }).encode()
+        if request.path == '/api/stats':
+            return HTTPStatus.OK, 'application/json', json.dumps(self.stats()).encode()
+        return HTTPStatus.NOT_FOUND, 'text/plain', b''
+
+    async def handle_bot_api(self, request: Request):
+        method = request.path.rsplit('/', 1)[-1]
+        self.count(f"tg {method}")
+        if request.headers.get('content-type', '').startswith('application/json'):
+            params = json.loads(request.body or b'{}')
+        else:
+            params = dict(parse_qsl(request.body.decode()))
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': "loadtest", 'username': "loadtest_bot"}
+        elif method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            self.on_message(chat_id, params['text'])
+            result = {'message_id': self.counts[f"tg {method}"], 'date': int(time.time()),
+                      'chat': {'id': chat_id, 'type': 'group'}, 'text': params['text']}
+        else:
+            result = True
+        return HTTPStatus.OK, 'application/json', json.dumps({'ok': True, 'result': result}).encode()
+
+    def on_message(self, chat_id, text):
+        game = self.games.get(f"s{chat_id}")
+        if game and game.pinged_age != game.age and text.startswith(game.names[game.current] + ","):
+            game.pinged_age = game.age
+            self.ping_latencies.append(time.time() - game.changed_at)
+
+    def stats(self):
+        return {'counts': self.counts, 'ping_latencies': self.ping_latencies, 'created': self.created}
+
+    async def run(self, ready):
+        for _ in range(self.args.games):
+            self.add_game(self.args.players)
+        game_api = await serve(self.handle_game_api, FAKE_HOST, 0)
+        bot_api = await serve(self.handle_bot_api, FAKE_HOST, 0)
+        ready.send((game_api.sockets[0].getsockname()[1], bot_api.sockets[0].getsockname()[1]))
+        await asyncio.Event().wait()
+
+
+def run_fake_servers(args, ready):
+    asyncio.run(FakeServers(args).run(ready))
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def monitor_loop_lag(lags, interval=0.1):
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        lags.append(time.monotonic() - started - interval)
+
+
+def make_persistence(args, host, state_dir):
+    """ persisted chats as if the bot was restarted while tracking args.games games """
+    from chat_games import ChatGames
+    from constants import ST_TRACKING
+    from game_data import GameData
+    from persistence import SqlitePersistence, encode_chat_data
+
+    persistence = SqlitePersistence(os.path.join(state_dir, 'persistence.sqlite3'))
+    rows = []
+    for idx in range(args.games):
+        games = ChatGames()
+        games.add(GameData(ST_TRACKING, host=host, game_id=f"s{idx}")).ping_delay_min = 0
+        rows.append((idx, encode_chat_data({'GAMES': games})))
+    persistence.import_rows(rows)
+    return persistence
+
+
+async def run_bot(args, game_port, bot_port):
+    from telegram.ext import Application
+
+    import main as bot
+    from constants import TURN_PASS
+    from game_api import game_api
+    from game_data import GameData
+    from newgame import GameCreator
+
+    host = f"{FAKE_HOST}:{game_port}"
+    builder = Application.builder().token(TOKEN).base_url(f"http://{FAKE_HOST}:{bot_port}/bot").updater(None)
+    # the state file comes with its -wal and -shm files, all of them go away with the directory
+    state_dir = tempfile.TemporaryDirectory(prefix='loadtest')
+    if args.warm:
+        builder.persistence(make_persistence(args, host, state_dir.name))
+    app = builder.build()
+    await app.initialize()
+    await app.start()
+    lags = []
+    lag_task = asyncio.create_task(monitor_loop_lag(lags))
+
+    rss_before = rss_bytes()
+    started = time.monotonic()
+    await bot.start_services(app)
+    limit = asyncio.Semaphore(100)
+
+    async def track(idx):
+        async with limit:
+            context = app.context_types.context(app, chat_id=idx)
+            data = GameData(game_id=f"s{idx}", host=host, state=None)
+            data.ping_delay_min = 0
+            await bot.start_tracking(idx, data, context)
+            if random.random() < args.pass_ratio:
+                username = f"user{idx}"
+                bot.get_games(context).set_player(data, username, f"Player{idx}x0", f"p{idx}x0").action = TURN_PASS
+                bot.turn_maker.schedule(app.job_queue, idx, data, username)
+
+    if args.warm:
+        while len(bot.poller.chat_games) < args.games:
+            await asyncio.sleep(0.01)
+    else:
+        await asyncio.gather(*(track(idx) for idx in range(args.games)))
+    startup = time.monotonic() - started
+
+    create_latencies = []
+
+    async def create(k):
+        creator = GameCreator(args.players)
+        creator.host = host
+        for p in range(args.players):
+            creator.add_player(f"New{k}x{p}", "red")
+        creator.options = {}
+        t = time.monotonic()
+        await creator.get_message()
+        create_latencies.append(time.monotonic() - t)
+
+    await asyncio.gather(*(create(k) for k in range(args.create)))
+
+    lags.clear()
+    await asyncio.sleep(args.duration)
+    rss_after = rss_bytes()
+    reply = await game_api.get_json(host, 'stats', '')
+    lag_task.cancel()
+    await bot.stop_services(app)
+    await app.stop()
+    await app.shutdown()
+    state_dir.cleanup()
+
+    counts = reply['counts']
+    polls = counts.get('GET /api/spectator', 0) + counts.get('GET /api/waitingfor', 0)
+    pings = reply['ping_latencies']
+    return {
+        'games': args.games,
+        'startup_s': round(startup, 2),
+        'polls_per_s': round(polls / (args.duration + startup), 1),
+        'pings': len(pings),
+        'ping_p50_s': round(percentile(pings, 0.5), 2),
+        'ping_p90_s': round(percentile(pings, 0.9), 2),
+        'ping_max_s': round(max(pings, default=float('nan')), 2),
+        'loop_lag_p99_ms': round(percentile(lags, 0.99) * 1000, 1),
+        'loop_lag_max_ms': round(max(lags, default=0) * 1000, 1),
+        'kb_per_game': round((rss_after - rss_before) / 1024 / max(args.games, 1), 1),
+        'passes': counts.get('passes', 0),
+        'created': reply['created'],
+        'create_mean_s': round(statistics.mean(create_latencies), 3) if create_latencies else None,
+    }
+
+
+def run_single(args):
+    logging.basicConfig(level=logging.WARNING)
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    fakes = multiprocessing.Process(target=run_fake_servers, args=(args, sender), daemon=True)
+    fakes.start()
+    game_port, bot_port = receiver.recv()
+    try:
+        print(json.dumps(asyncio.run(run_bot(args, game_port, bot_port))))
+    finally:
+        fakes.terminate()
+
+
+COLUMNS = ['games', 'startup_s', 'polls_per_s', 'pings', 'ping_p50_s', 'ping_p90_s', 'ping_max_s',
+           'loop_lag_p99_ms', 'loop_lag_max_ms', 'kb_per_game', 'passes', 'created', 'create_mean_s']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--duration', type=float, default=60, help="seconds to measure after startup")
+    parser.add_argument('--latency', type=float, default=0.05, help="game server latency, seconds")
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--turn-seconds', type=float, default=30, help="turn length in scripted games")
+    parser.add_argument('--turns', type=int, default=200, help="turns before a scripted game ends")
+    parser.add_argument('--pass-ratio', type=float, default=0.1, help="share of games with a scheduled /pass")
+    parser.add_argument('--create', type=int, default=5, help="games to create through GameCreator")
+    parser.add_argument('--warm', action='store_true', help="resume the games from persistence as after a restart")
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        args.games = args.games[0]
+        run_single(args)
+        return
+
+    # every size runs in a fresh process, the bot keeps its state in module globals
+    print('\t'.join(COLUMNS))
+    for games in args.games:
+        cmd = [sys.executable, __file__, '--single', '--games', str(games)] + [
+            f"--{name.replace('_', '-')}={value}" for name, value in vars(args).items()
+            if name not in ('games', 'single') and not isinstance(value, bool)
+        ] + (['--warm'] if args.warm else [])
+        out = subprocess.run(cmd, capture_output=True, text=True)
+        if out.returncode != 0:
+            print(out.stderr, file=sys.stderr)
+            continue
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        print('\t'.join(str(result[c]) for c in COLUMNS))
+
+
+if __name__ == "__main__":
+    main()
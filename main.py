@@ -1,63 +1,87 @@
+import asyncio
 import sys
-import requests
 import logging
-import datetime as dt
 import time
-from telegram import Update
+from telegram import LinkPreviewOptions, Update
+from telegram.constants import ChatType
+from telegram.error import BadRequest, Forbidden
 from telegram.ext import (
-    Application, CommandHandler, ContextTypes, MessageHandler,
-    filters, PicklePersistence
+    Application, CommandHandler, ContextTypes, MessageHandler, TypeHandler, filters
 )
 
-from config import TOKEN, UPDATE_FREQUENCY, LOG_NAME, MESSAGE_HISTORY
-from constants import (ST_TRACKING, ST_PAUSED, ST_WAIT_GAME_ID, LANG_RU, LANG_EN,
-                       MESSAGE_DELETE_TIMEOUT, PHASE_DRAFTING, PHASE_RESEARCH, TURN_PASS)
+import metrics
+from change_probe import ChangeProbe
+from chat_games import ChatGames
+from chat_locks import ChatOrderedProcessor, chat_lock
+from config import (TOKEN, LOG_NAME, MESSAGE_HISTORY, SWEEP_FREQUENCY, PERSISTENCE_FILE, LEGACY_PERSISTENCE_FILE,
+                    ADMIN_IDS, RUN_MODE, UPDATE_QUEUE_SIZE, MAX_CONCURRENT_UPDATES, RESUME_BATCH, SHARDS,
+                    RECORD_HISTORY, HISTORY_FLUSH_FREQUENCY, DEFAULT_HOST, DIGEST_FREQUENCY, POLL_TICK,
+                    COLD_AFTER, EVICT_FREQUENCY)
+from constants import (ST_TRACKING, ST_PAUSED, ST_FINISHED, LANG_RU, LANG_EN, MESSAGE_DELETE_TIMEOUT,
+                       MAX_MESSAGE_LENGTH, PHASE_DRAFTING, PHASE_RESEARCH, PHASE_END, TURN_PASS, RUN_WEBHOOK,
+                       FLEET_TURNS)
+from digest import Digest, DigestUser
+from dispatcher import MessageDispatcher
+from game_api import game_api, CircuitOpenError, CIRCUIT_CLOSED
 from game_data import GameData
 from l18n import (l18n, get_turn_type_str, LK_WAIT_GAME_ID, LK_BAD_GAME_ID, LK_WILL_PASS, LK_WILL_NOT_PASS,
                   LK_PASSED, LK_START_GONE_WRONG, LK_PAUSE, LK_WILL_TAG, LK_TAG_COMMAND_ERROR, LK_WILL_NOT_TAG,
                   LK_NEVER_TAGGED, LK_DELAY_SET, LK_DELAY_COMMAND_ERROR, LK_START_COMMAND_ERROR, LK_LANG_SWITCHED,
-                  LK_SETLANG_COMMAND_ERROR, LK_UNEXPECTED_MESSAGE)
-from newgame import GameCreator
-from util import build_api_url, looks_like_player_id, try_parse_game_url
-
-
-class TurnMaker:
-    @staticmethod
-    def find_pass_option_index(api_reply):
-        options = api_reply['waitingFor']['options']
-        for i, option in enumerate(options):
-            if option['title'] == "Pass for this generation":
-                return i
-        raise RuntimeError("Not found passing option")
-
-    @staticmethod
-    def try_pass(game_data: GameData, ingame_player_name):
-        logging.info("check pass for {}".format(ingame_player_name))
-        for username, (player_name, player_id) in game_data.users_info.items():
-            if player_name == ingame_player_name and game_data.scheduled_turns.get(username) == TURN_PASS:
-                # prepare request param
-                url = build_api_url(game_data.host, 'player', player_id)
-                reply = requests.get(url).json()
-                pass_idx = TurnMaker.find_pass_option_index(reply)
-                post_url = f"http://{game_data.host}/player/input?id={player_id}"
-                reply = requests.post(post_url, json={
-                    'type': 'or',
-                    'index': pass_idx,
-                    'response': {
-                        'type': 'option'
-                    }
-                })
-                if reply.status_code != 200:
-                    logging.error("Passing failed")
-                    return False
-                game_data.scheduled_turns.pop(username)
-                return True
-        return False
+                  LK_SETLANG_COMMAND_ERROR, LK_UNEXPECTED_MESSAGE, LK_SERVER_DOWN, LK_SERVER_UP, LK_TURN_STATS,
+                  LK_TURN_STATS_ALL, LK_NO_TURN_STATS, LK_TURN_STATS_LINE, LK_DIGEST_ON, LK_DIGEST_OFF,
+                  LK_DIGEST_PRIVATE, LK_DIGEST_NO_USERNAME, LK_DIGEST, LK_DIGEST_EMPTY, LK_WHICH_GAME, LK_STOPPED)
+from newgame import GameCreator, TABLES_USAGE, create_tables, parse_tables, player_link
+from persistence import SqlitePersistence, import_pickle, read_stats
+from poller import GamePoller, PolledGame
+from progress import ProgressEngine
+from recorder import HistoryRecorder
+from snapshot import GameSnapshot, get_current_players, parse_snapshot
+from turn_maker import TurnMaker
+from turn_stats import QuantileSketch, finished_turns, format_duration
+from util import looks_like_player_id, try_parse_game_url
+
+
+def get_games(context: ContextTypes.DEFAULT_TYPE) -> ChatGames:
+    return context.chat_data.setdefault('GAMES', ChatGames())
+
+
+def stop_tracking(chat_id, data: GameData):
+    """ stops tracking one of the chat's games, the others are tracked on """
+    poller.unsubscribe(chat_id, (data.host, data.game_id))
+    turn_maker.cancel_game(chat_id, data)
+    digest.forget(chat_id, data)
+
+
+def in_game(context: ContextTypes.DEFAULT_TYPE, data: GameData, text):
+    """ names the game if the chat tracks several """
+    games = context.chat_data.get('GAMES')
+    if games is not None and len(games) > 1 and len(games.active()) > 1:
+        return f"[{data.label}] {text}"
+    return text
+
+
+async def pick_game(update: Update, context: ContextTypes.DEFAULT_TYPE, args, name=None):
+    """
+    finds the game a command is about: the one labelled by the first argument, or else the only
+    active game of the user, of the in-game name or of the chat; returns it with the rest of the arguments
+    """
+    games = get_games(context)
+    if args and (data := games.get(args[0])):
+        return data, args[1:]
+    for candidates in (games.of_user(update.effective_user.username), games.of_name(name) if name else (), games):
+        candidates = [data for data in candidates if data.state != ST_FINISHED]
+        if len(candidates) == 1:
+            return candidates[0], args
+        if candidates:
+            break
+    if len(games):
+        await update.effective_message.reply_text(l18n(context, LK_WHICH_GAME).format(', '.join(games.games)))
+    else:
+        await start(update, context)
+    return None, args
 
 
 async def new_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if 'GAME' in context.chat_data:
-        context.chat_data.pop('GAME')
     if len(context.args) == 0:
         await update.message.reply_text(GameCreator.get_usage())
     else:
@@ -65,40 +89,75 @@ async def new_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=update.effective_chat.id,
                                        disable_notification=True,
                                        text=creator.get_header())
-        await update.message.reply_text(creator.get_message(), disable_notification=True)
+        await update.message.reply_text(await creator.get_message(), disable_notification=True)
 
 
-def get_game_data(context: ContextTypes.DEFAULT_TYPE) -> GameData:
-    return context.chat_data['GAME']
+async def new_tables(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        options, tables = parse_tables(update.message.text)
+    except (KeyError, ValueError) as e:
+        logging.info("Bad /tables message: %r", e)
+        await update.message.reply_text(TABLES_USAGE)
+        return
+    await update.message.reply_text(f"Создаю игры: {len(tables)}, пришлю ссылки, когда будут готовы",
+                                    disable_notification=True)
+    # the chat is not blocked while the games are being created
+    context.application.create_task(set_up_tables(context, update.effective_chat.id, options, tables),
+                                    name=f"tables {update.effective_chat.id}")
+
+
+async def set_up_tables(context: ContextTypes.DEFAULT_TYPE, chat_id, options, tables):
+    host = DEFAULT_HOST
+    created = await create_tables(host, options, tables)
+    async with chat_lock(chat_id):
+        games = get_games(context)
+        for table in created:
+            metrics.observe('table_create_seconds', table.seconds)
+            if table.game_id is None:
+                continue
+            if old := games.get(table.label):
+                stop_tracking(chat_id, old)
+            data = games.add(GameData(ST_TRACKING, host=host, game_id=table.game_id), table.label)
+            poller.subscribe(context.job_queue, chat_id, data)
+        context.application.mark_data_for_update_persistence(chat_ids=chat_id)
+    lines = []
+    for table in created:
+        if table.error:
+            lines.append(f"{table.label}: не создана, {table.error}")
+        else:
+            lines.append(f"{table.label} ({table.seconds:.1f} с): " +
+                         ', '.join(f"{name} {link}" for name, link in table.links))
+    report = []
+    for line in lines:
+        # stay under the message length limit
+        if report and len(report[-1]) + len(line) < MAX_MESSAGE_LENGTH:
+            report[-1] += '\n' + line
+        else:
+            report.append(line)
+    for text in report:
+        dispatcher.send(chat_id, text, link_preview_options=LinkPreviewOptions(is_disabled=True))
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.chat_data['GAME'] = GameData(ST_WAIT_GAME_ID)
+    get_games(context).waiting = True
     await update.message.reply_text(l18n(context, LK_WAIT_GAME_ID))
 
 
-def get_game_status(host, game_id):
-    url = build_api_url(host, "spectator", game_id)
+async def get_game_status(host, game_id):
     try:
-        return requests.get(url).json()
+        reply = await game_api.get(host, "spectator", {'id': game_id})
+        reply.raise_for_status()
+        return parse_snapshot(reply.content)
+    except CircuitOpenError:
+        logging.warning("Not getting status of game %s, %s is down", game_id, host)
     except Exception:
-        pass
-
-
-def get_current_players(reply):
-    out = []
-    for player in reply['players']:
-        if player['timer']['running']:
-            out.append((player['name'], player['timer']['startedAt']))
-    if not out:
-        raise RuntimeError("Cannot find current player")
-    return tuple(out)
+        logging.exception("Failed to get status of game %s at %s", game_id, host)
 
 
 def address_player(game: GameData, player_name):
-    username = game.users_tag.get(player_name)
-    if username:
-        return f"@{username}"
+    player = game.player_by_name(player_name)
+    if player and player.tagged:
+        return f"@{player.username}"
     return player_name
 
 
@@ -110,16 +169,19 @@ async def schedule_pass(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info("Called schedule_pass()")
     # check if we already know id of the user
     user = update.message.from_user
-    data: GameData = get_game_data(context)
-    logging.info("Current users_info = {}".format(data.users_info))
-    user_info = data.users_info.get(user.username)
+    args = context.args
+    data, args = await pick_game(update, context, args, name=args[-2] if len(args) >= 2 else None)
+    if data is None:
+        return
+    player = data.player(user.username)
+    logging.info("Current player = %s", player)
     # ask to retry with id if unknown and not given
-    if not user_info or not all(user_info):
+    if not player or not player.name or not player.player_id:
         try:
-            name, player_id = context.args[0], context.args[1]
+            name, player_id = args[0], args[1]
             assert looks_like_player_id(player_id)
-            data.users_info[user.username] = [name, player_id]
-            logging.info("Setting users_info, now is {}".format(data.users_info))
+            player = get_games(context).set_player(data, user.username, name, player_id)
+            logging.info("Setting player, now is %s", player)
         except IndexError:
             # TODO l18n
             msg = ("Нужны твое имя в игре и id (12-13 символов). "
@@ -129,147 +191,366 @@ async def schedule_pass(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except AssertionError:
             await update.effective_message.reply_text(l18n(context, LK_BAD_GAME_ID))
     # add to passing queue
-    user_info = data.users_info.get(user.username)
-    if user_info and all(user_info):
-        data.scheduled_turns[user.username] = TURN_PASS
+    if player and player.name and player.player_id:
+        player.action = TURN_PASS
+        turn_maker.schedule(context.job_queue, update.effective_chat.id, data, user.username)
         await update.effective_message.reply_text(l18n(context, LK_WILL_PASS))
 
 
 async def unschedule_pass(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # NOTE: in fact unschedules any actions
-    data: GameData = get_game_data(context)
+    # NOTE: in fact unschedules any actions, in all games of the user
     username = update.message.from_user.username
-    data.scheduled_turns.pop(username)
+    for data in get_games(context).of_user(username):
+        data.player(username).action = None
+        turn_maker.cancel(update.effective_chat.id, data, username)
     await update.effective_message.reply_text(l18n(context, LK_WILL_NOT_PASS))
 
 
-async def callback_timer(context: ContextTypes.DEFAULT_TYPE):
-    data: GameData = context.job.data
-    logging.info("Timer event: gamedata = {}".format(data))
-    status = get_game_status(data.host, data.game_id)
-    if not status:
+def remember_message(context: ContextTypes.DEFAULT_TYPE, chat_id, data: GameData):
+    def on_sent(msg):
+        data.message_ids_queue.append((msg.message_id, clock()))
+        context.application.mark_data_for_update_persistence(chat_ids=chat_id)
+    return on_sent
+
+
+async def sweep_messages(context: ContextTypes.DEFAULT_TYPE):
+    """
+    deletes bot messages beyond the last MESSAGE_HISTORY ones in all chats, and the last ones too
+    once they are about to outlive the time Telegram allows deleting them in
+    """
+    now = clock()
+    # the next sweep may already be too late for messages older than this
+    retire_before = now - (MESSAGE_DELETE_TIMEOUT - 2 * SWEEP_FREQUENCY)
+    swept = []
+    expired = 0
+    for chat_id, chat_data in context.application.chat_data.items():
+        old = []
+        trimmed = False
+        for data in chat_data.get('GAMES', ()):
+            queue = data.message_ids_queue
+            while queue and (len(queue) > MESSAGE_HISTORY or queue[0][1] < retire_before):
+                trimmed = True
+                message_id, sent_at = queue.popleft()
+                if (now - sent_at) < MESSAGE_DELETE_TIMEOUT:
+                    old.append(message_id)
+                else:
+                    expired += 1
+        if old:
+            dispatcher.delete(chat_id, old)
+        if trimmed:
+            swept.append(chat_id)
+    if expired:
+        logging.warning("%d messages were too old to delete", expired)
+    if swept:
+        context.application.mark_data_for_update_persistence(chat_ids=swept)
+
+
+def action_players(status: GameSnapshot):
+    return status.current_players if status.phase not in (PHASE_DRAFTING, PHASE_RESEARCH, PHASE_END) else ()
+
+
+def record_turns(data: GameData, status: GameSnapshot):
+    """ counts action phase turns which are over since the last status """
+    players = action_players(status)
+    if players == data.turn_players:
+        return
+    for name, seconds in finished_turns(data.turn_players, players, clock()):
+        data.turn_stats.observe(name, seconds)
+    data.turn_players = players
+
+
+def observe_change(key, status: GameSnapshot, game: PolledGame):
+    """ bookkeeping of a new status of a polled game, done once however many chats track the game """
+    progress.observe(key, status, game)
+    if game is not None:
+        players = action_players(status)
+        for _, seconds in finished_turns(game.turn_players, players, clock()):
+            fleet_turns.add(seconds)
+        game.turn_players = players
+    if recorder:
+        recorder.record(*key, status)
+
+
+async def process_status(context: ContextTypes.DEFAULT_TYPE, chat_id, data: GameData, status: GameSnapshot):
+    logging.debug("Processing status: chat_id = %s, gamedata = %s", chat_id, data)
+    record_turns(data, status)
+    if status.current_players:
+        data.last_turn_at = max(p[1] for p in status.current_players) // 1000
+    if (games := context.chat_data.get('GAMES')) is not None:
+        games.note_names(data, status.player_names)
+    digest.update(chat_id, data, status.phase, status.current_players if status.phase != PHASE_END else ())
+
+    phase = status.phase
+    if phase == PHASE_END:
         return
-
-    if ans := data.tft.check(status):
-        oceans, oxygen, temp = ans
-        msg = await context.bot.send_message(chat_id=context.job.chat_id,
-                                             parse_mode='Markdown',
-                                             text=data.tft.make_message(context, oceans, oxygen, temp))
-        data.message_ids_queue.append((msg.message_id, time.time()))
-
-    phase = status['game']['phase']
     if phase == PHASE_DRAFTING:
-        data.scheduled_turns = {}
+        data.clear_actions()
     players = get_current_players(status)
     turn_type_str = get_turn_type_str(context, phase, len(players) > 1)
     if players != data.last_ping:
-        passed = False
-        if len(players) == 1 and phase not in (PHASE_DRAFTING, PHASE_RESEARCH):
-            passed = TurnMaker.try_pass(data, players[0][0])
-        if passed:
-            reply_text = l18n(context, LK_PASSED) + players[0][0]
-            await context.bot.send_message(chat_id=context.job.chat_id,
-                                           text=reply_text)
-        else:
-            last_turn = max([dt.datetime.fromtimestamp(p[1] // 1000) for p in players])
-            if (dt.datetime.now() - last_turn) > dt.timedelta(minutes=data.ping_delay_min):
-                who = address_players(get_game_data(context), [p[0] for p in players])
-                reply_text = f"{who}, {turn_type_str}"
+        will_pass = (len(players) == 1 and phase not in (PHASE_DRAFTING, PHASE_RESEARCH)
+                     and turn_maker.is_pending(data, players[0][0]))
+        if not will_pass:
+            last_turn = max(p[1] for p in players) // 1000
+            if clock() - last_turn > data.ping_delay_min * 60:
                 data.last_ping = players
-                msg = await context.bot.send_message(chat_id=context.job.chat_id,
-                                               text=reply_text)
-                data.message_ids_queue.append((msg.message_id, time.time()))
-                while len(data.message_ids_queue) > MESSAGE_HISTORY:
-                    hmsg = data.message_ids_queue.pop(0)
-                    if (time.time() - hmsg[1]) < MESSAGE_DELETE_TIMEOUT:
-                        await context.bot.delete_message(chat_id=context.job.chat_id,
-                                                         message_id=hmsg[0])
-
-
-async def start_tracking(chat_id, host, game_id, context: ContextTypes.DEFAULT_TYPE, do_restore=True):
-    st = get_game_status(host, game_id)
+                # players with the digest learn about their turn from it
+                names = [p[0] for p in players if not digest.covers(data, p[0])]
+                if names:
+                    reply_text = in_game(context, data, f"{address_players(data, names)}, {turn_type_str}")
+                    dispatcher.ping(chat_id, reply_text, on_sent=remember_message(context, chat_id, data),
+                                    key=(data.host, data.game_id))
+
+
+async def poll_game_status(host, game_id):
+    try:
+        status, changed = await change_probe.fetch(host, game_id)
+        if changed:
+            observe_change((host, game_id), status, poller.games.get((host, game_id)))
+        return status, changed
+    except CircuitOpenError:
+        return None, False
+    except Exception:
+        logging.exception("Failed to poll game %s at %s", game_id, host)
+        return None, False
+
+
+async def report_pass(context: ContextTypes.DEFAULT_TYPE, chat_id, data: GameData, player_name):
+    dispatcher.send(chat_id, in_game(context, data, l18n(context, LK_PASSED) + player_name))
+
+
+def report_host_state(app: Application, host, available):
+    """ tells chats tracking games at the host once when it goes down and once when it is back """
+    key = LK_SERVER_UP if available else LK_SERVER_DOWN
+    # a chat may track several games at the host
+    chat_ids = {chat_id for (game_host, _), game in poller.games.items() if game_host == host for chat_id in game.chats}
+    for chat_id in chat_ids:
+        context = app.context_types.context(app, chat_id=chat_id)
+        dispatcher.send(chat_id, l18n(context, key).format(host))
+
+
+def count_open_circuits():
+    return {(('host', host),): int(health.state != CIRCUIT_CLOSED) for host, health in game_api.health.items()}
+
+
+def forget_game(host, game_id):
+    change_probe.forget(host, game_id)
+    progress.forget((host, game_id))
+    if recorder:
+        recorder.forget(host, game_id)
+
+
+async def announce_progress(context: ContextTypes.DEFAULT_TYPE):
+    """ tells the chats about their games which went over a 10% threshold of terraforming since the last tick """
+    app = context.application
+    with metrics.timed('progress_pass_seconds'):
+        crossings = progress.crossings()
+    announced = []
+    for crossing in crossings:
+        if crossing.owner is None:
+            continue
+        for chat_id, data in crossing.owner.chats.items():
+            if data.tft.report(crossing.percent):
+                chat_context = app.context_types.context(app, chat_id=chat_id)
+                text = data.tft.make_message(chat_context, crossing.status, crossing.generations_left)
+                dispatcher.send(chat_id, in_game(chat_context, data, text),
+                                on_sent=remember_message(chat_context, chat_id, data), parse_mode='Markdown')
+                announced.append(chat_id)
+    if announced:
+        app.mark_data_for_update_persistence(chat_ids=announced)
+
+
+async def flush_history(_: ContextTypes.DEFAULT_TYPE):
+    recorder.flush()
+
+
+def format_digest(context: ContextTypes.DEFAULT_TYPE, user: DigestUser):
+    if not user.turns:
+        return l18n(context, LK_DIGEST_EMPTY)
+    text = l18n(context, LK_DIGEST)
+    for entry in sorted(user.turns.values(), key=lambda e: e.started):
+        line = f"{entry.title}: {get_turn_type_str(context, entry.phase, False)}"
+        if entry.player_id:
+            line += f" {player_link(entry.host, entry.player_id)}"
+        if len(text) + len(line) >= MAX_MESSAGE_LENGTH:
+            break
+        text += '\n' + line
+    return text
+
+
+async def send_digests(context: ContextTypes.DEFAULT_TYPE):
+    """ brings the digest messages of users whose games changed up to date """
+    app = context.application
+    for user in digest.pop_dirty():
+        user_context = app.context_types.context(app, chat_id=user.user_id)
+        text = format_digest(user_context, user)
+        if user.notify or (user.message_id is None and user.turns):
+            # a new message to be notified of, the old one goes away
+            if user.message_id is not None:
+                dispatcher.delete(user.user_id, [user.message_id])
+                user.message_id = None
+            dispatcher.send(user.user_id, text, on_sent=digest_sent(app, user), on_failed=digest_failed(app, user),
+                            link_preview_options=LinkPreviewOptions(is_disabled=True))
+        elif user.message_id is not None and text != user.text:
+            dispatcher.edit(user.user_id, user.message_id, text, on_failed=digest_failed(app, user),
+                            link_preview_options=LinkPreviewOptions(is_disabled=True))
+        user.notify = False
+        user.text = text
+        app.mark_data_for_update_persistence(chat_ids=user.user_id)
+
+
+def digest_sent(app: Application, user: DigestUser):
+    def on_sent(msg):
+        user.message_id = msg.message_id
+        app.mark_data_for_update_persistence(chat_ids=user.user_id)
+    return on_sent
+
+
+def digest_failed(app: Application, user: DigestUser):
+    def on_failed(error):
+        if isinstance(error, Forbidden):
+            logging.info("User %s blocked the bot, dropping their digest", user.username)
+            digest.unsubscribe(user.username)
+            app.chat_data[user.user_id].pop('DIGEST', None)
+            app.mark_data_for_update_persistence(chat_ids=user.user_id)
+        elif isinstance(error, BadRequest) and 'not modified' in error.message:
+            pass
+        else:
+            # e.g. the message was deleted by the user, the next update sends a new one
+            logging.warning("Failed to update the digest of %s: %s", user.username, error)
+            user.message_id = None
+            user.text = None
+            digest.dirty.add(user.username)
+    return on_failed
+
+
+clock = time.time  # replay.py runs the pipeline on a virtual clock
+fleet_turns = QuantileSketch()  # turn times of all games, kept in the persistence file
+shard_files = []  # persistence files of the other shards, their turn times are added to /turnstats
+dispatcher = MessageDispatcher()
+digest = Digest()
+change_probe = ChangeProbe()
+progress = ProgressEngine()
+recorder = HistoryRecorder() if RECORD_HISTORY else None
+poller = GamePoller(poll_game_status, process_status, forget_game)
+turn_maker = TurnMaker(report_pass)
+
+
+async def start_tracking(chat_id, game_data: GameData, context: ContextTypes.DEFAULT_TYPE):
+    st = await get_game_status(game_data.host, game_data.game_id)
     if st:
         players = get_current_players(st)
         whose = (f"ходит {players[0][0]}"
-                 if st["game"]["phase"] not in (PHASE_DRAFTING, PHASE_RESEARCH)
+                 if st.phase not in (PHASE_DRAFTING, PHASE_RESEARCH)
                  else "драфт")
-        reply_text = f"Ок, слежу за игрой id={game_id}, сейчас {whose}"  # TODO l18n
-        game_data = get_game_data(context)
-        if do_restore:
-            game_data.restore()
+        games = get_games(context)
+        if games.get(game_data.label) is not game_data:
+            games.add(game_data)
+        reply_text = in_game(context, game_data,
+                             f"Ок, слежу за игрой id={game_data.game_id}, сейчас {whose}")  # TODO l18n
         game_data.state = ST_TRACKING
-        context.job_queue.run_repeating(
-            callback_timer, UPDATE_FREQUENCY,
-            data=game_data,
-            chat_id=chat_id
-        )
+        poller.subscribe(context.job_queue, chat_id, game_data)
+        turn_maker.resume(context.job_queue, chat_id, game_data)
         await context.bot.send_message(chat_id=chat_id, text=reply_text)
     else:
         raise RuntimeError()
 
 
 async def pause(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        get_game_data(context).state = ST_PAUSED
-        await context.job_queue.stop()
-        await context.bot.send_message(chat_id=update.effective_chat.id,
-                                       text=l18n(context, LK_PAUSE))
-    except KeyError:
+    games = get_games(context)
+    if not len(games):
         await start(update, context)
+        return
+    for data in games:
+        if data.state == ST_TRACKING:
+            data.state = ST_PAUSED
+        digest.forget(update.effective_chat.id, data)
+    poller.unsubscribe(update.effective_chat.id)
+    turn_maker.cancel_chat(update.effective_chat.id)
+    await context.bot.send_message(chat_id=update.effective_chat.id,
+                                   text=l18n(context, LK_PAUSE))
 
 
 async def unpause(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        data = get_game_data(context)
-        await context.job_queue.start()
-        await start_tracking(update.effective_chat.id, data.host, data.game_id, context)
-    except KeyError:
+    games = get_games(context)
+    if not len(games):
         await start(update, context)
+        return
+    for data in games:
+        if data.state == ST_PAUSED:
+            try:
+                await start_tracking(update.effective_chat.id, data, context)
+            except RuntimeError:
+                await update.effective_message.reply_text(in_game(context, data, l18n(context, LK_START_GONE_WRONG)))
+
+
+async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    data, _ = await pick_game(update, context, context.args)
+    if data is None:
+        return
+    stop_tracking(update.effective_chat.id, get_games(context).remove(data.label))
+    if context.application.persistence:
+        # a copy left by thaw_games
+        context.application.persistence.drop_cold(update.effective_chat.id, data.label)
+    await update.effective_message.reply_text(l18n(context, LK_STOPPED).format(data.label))
 
 
 async def turn_on_tagging(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    assert 'GAME' in context.chat_data
-    try:
-        ingame_name = context.args[0]
-        data: GameData = get_game_data(context)
-        data.users_tag[ingame_name] = user.username
-        if user.username not in data.users_info:
-            data.users_info[user.username] = [ingame_name, None]
-        else:
-            data.users_info[user.username][0] = ingame_name
-        await update.effective_message.reply_text(l18n(context, LK_WILL_TAG))
-    except IndexError:
+    games = get_games(context)
+    args = context.args
+    if not args:
         await update.effective_message.reply_text(l18n(context, LK_TAG_COMMAND_ERROR))
-    except KeyError:
-        await start(update, context)
+        return
+    ingame_name = args[-1]
+    # the name is tagged in every game it plays unless a game is given
+    targets = games.of_name(ingame_name) if len(args) == 1 else []
+    if not targets:
+        data, _ = await pick_game(update, context, args)
+        if data is None:
+            return
+        targets = [data]
+    for data in targets:
+        games.set_player(data, user.username, ingame_name).tagged = True
+    await update.effective_message.reply_text(l18n(context, LK_WILL_TAG))
 
 
 async def turn_off_tagging(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    game_data = get_game_data(context)
-    found = game_data.users_info.get(user.username)
-    if found:
-        game_data.users_tag.pop(found[0])
+    tagged = [player for data in get_games(context).of_user(user.username)
+              if (player := data.player(user.username)).tagged]
+    for player in tagged:
+        player.tagged = False
+    if tagged:
         await update.effective_message.reply_text(l18n(context, LK_WILL_NOT_TAG))
     else:
         await update.effective_message.reply_text(l18n(context, LK_NEVER_TAGGED))
 
 
 async def set_delay(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    games = get_games(context)
+    args = context.args
+    # all games of the chat unless a game is given
+    targets = list(games)
+    if len(args) > 1:
+        targets = [games.get(args[0])] if games.get(args[0]) else []
+        args = args[1:]
     try:
-        v = int(context.args[0])
-        get_game_data(context).ping_delay_min = v
+        v = int(args[0])
+        assert targets
+        for data in targets:
+            data.ping_delay_min = v
         await update.effective_message.reply_text(l18n(context, LK_DELAY_SET).format(v))
-    except (IndexError, ValueError):
+    except (IndexError, ValueError, AssertionError):
         await update.effective_message.reply_text(l18n(context, LK_DELAY_COMMAND_ERROR))
 
 
 async def set_id(update: Update, context: ContextTypes.DEFAULT_TYPE, host, game_id):
-    assert context.chat_data['GAME'].state == ST_WAIT_GAME_ID
+    games = get_games(context)
     try:
-        context.chat_data['GAME'] = GameData(game_id=game_id, host=host, state=None)
-        await start_tracking(update.effective_chat.id, host, game_id, context, do_restore=False)
+        await start_tracking(update.effective_chat.id, games.find(host, game_id) or GameData(None, host, game_id),
+                             context)
+        games.waiting = False
     except RuntimeError:
         reply_text = l18n(context, LK_START_COMMAND_ERROR)
         await context.bot.send_message(chat_id=update.effective_chat.id,
@@ -278,7 +559,7 @@ async def set_id(update: Update, context: ContextTypes.DEFAULT_TYPE, host, game_
 
 async def handle_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
-    if get_game_data(context).state == ST_WAIT_GAME_ID:
+    if (games := context.chat_data.get('GAMES')) is not None and games.waiting:
         parsed = try_parse_game_url(text)
         if parsed:
             host, game_id = parsed
@@ -286,14 +567,13 @@ async def handle_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif (creator := context.chat_data.get('CREATOR')) and not creator.started:
         try:
             creator.consume_message(text)
-            await update.effective_message.reply_text(creator.get_message(), disable_notification=True)
+            await update.effective_message.reply_text(await creator.get_message(), disable_notification=True)
         except Exception:
             await update.effective_message.reply_text(
                 "Что-то пошло не так, проверьте формат и название цвета/опции",
                 disable_notification=True
             )
         if creator.started:
-            context.chat_data['GAME'] = GameData(ST_WAIT_GAME_ID)
             await set_id(update, context, creator.host, creator.game_id)
     elif orig := update.message.reply_to_message:
         me = await context.bot.get_me()
@@ -311,29 +591,273 @@ async def set_lang(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text(l18n(context, LK_SETLANG_COMMAND_ERROR))
 
 
-def main():
-    persistence = PicklePersistence(filepath='persistence.pickle', update_interval=30)
-    app = Application.builder() \
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    if not metrics.enabled:
+        await update.effective_message.reply_text("Metrics are disabled, see METRICS_ENABLED")
+        return
+    await update.effective_message.reply_text(metrics.registry.summary())
+
+
+def format_turn_stats(context: ContextTypes.DEFAULT_TYPE, title, sketch: QuantileSketch):
+    return l18n(context, LK_TURN_STATS_LINE).format(
+        title, sketch.count, format_duration(sketch.mean()),
+        format_duration(sketch.quantile(0.5)), format_duration(sketch.quantile(0.9)))
+
+
+async def show_turn_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    data, _ = await pick_game(update, context, context.args)
+    if data is None:
+        return
+    if not data.turn_stats.players:
+        await update.effective_message.reply_text(l18n(context, LK_NO_TURN_STATS))
+        return
+    lines = [l18n(context, LK_TURN_STATS)]
+    for name, sketch in sorted(data.turn_stats.players.items(), key=lambda item: -item[1].quantile(0.5)):
+        lines.append(format_turn_stats(context, name, sketch))
+    lines.append('')
+    lines.append(format_turn_stats(context, l18n(context, LK_TURN_STATS_ALL), all_turns()))
+    await update.effective_message.reply_text('\n'.join(lines))
+
+
+def all_turns():
+    if not shard_files:
+        return fleet_turns
+    total = QuantileSketch()
+    total.merge(fleet_turns)
+    for path in shard_files:
+        if saved := read_stats(path, FLEET_TURNS):
+            total.merge(QuantileSketch.from_dict(saved))
+    return total
+
+
+async def save_turn_stats(context: ContextTypes.DEFAULT_TYPE):
+    context.application.persistence.save_stats(FLEET_TURNS, fleet_turns.to_dict())
+
+
+async def toggle_digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if update.effective_chat.type != ChatType.PRIVATE:
+        await update.effective_message.reply_text(l18n(context, LK_DIGEST_PRIVATE))
+    elif 'DIGEST' in context.chat_data:
+        digest.unsubscribe(context.chat_data.pop('DIGEST').username)
+        await update.effective_message.reply_text(l18n(context, LK_DIGEST_OFF))
+    elif not user.username:
+        await update.effective_message.reply_text(l18n(context, LK_DIGEST_NO_USERNAME))
+    else:
+        digest.subscribe(context.chat_data.setdefault('DIGEST', DigestUser(user.id, user.username)))
+        await update.effective_message.reply_text(l18n(context, LK_DIGEST_ON))
+
+
+def is_cold(data: GameData, now):
+    # the sweeper still has to delete the game's last messages
+    if data.message_ids_queue:
+        return False
+    return data.state == ST_FINISHED or (data.last_turn_at is not None and now - data.last_turn_at > COLD_AFTER)
+
+
+def can_unload(chat_data):
+    """ whether nothing of the chat is needed until its next update """
+    games = chat_data.get('GAMES')
+    creator = chat_data.get('CREATOR')
+    return ((games is None or not (len(games) or games.waiting))
+            and 'DIGEST' not in chat_data and (creator is None or creator.started))
+
+
+async def evict_games(context: ContextTypes.DEFAULT_TYPE):
+    """
+    moves finished games and games without a new turn for COLD_AFTER to cold storage, and chats left
+    with nothing in memory out of it, so that memory follows the games being played
+    """
+    app = context.application
+    now = clock()
+    frozen = 0
+    unloaded = 0
+    for chat_id, chat_data in list(app.chat_data.items()):
+        games = chat_data.get('GAMES', ())
+        for data in games:
+            if data.last_turn_at is None:
+                # e.g. resumed from before the time was kept, the period starts now
+                data.last_turn_at = now
+        if not any(is_cold(data, now) for data in games) and not (chat_data and can_unload(chat_data)):
+            continue
+        async with chat_lock(chat_id):
+            for data in [data for data in games if is_cold(data, now)]:
+                stop_tracking(chat_id, data)
+                app.persistence.freeze(chat_id, games.freeze(data.label))
+                metrics.inc('games_frozen_total')
+                frozen += 1
+            if can_unload(chat_data):
+                await app.persistence.update_chat_data(chat_id, chat_data)
+                app.persistence.unload(chat_id)
+                chat_data.clear()
+                unloaded += 1
+            else:
+                app.mark_data_for_update_persistence(chat_ids=chat_id)
+    if frozen or unloaded:
+        logging.info("Moved %d games to cold storage, unloaded %d chats", frozen, unloaded)
+
+
+async def thaw_games(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """ brings the chat's games back from cold storage before its update is handled """
+    if update.effective_chat is None:
+        return
+    games = context.chat_data.get('GAMES')
+    if games is None or not games.cold or not context.application.persistence:
+        return
+    chat_id = update.effective_chat.id
+    for label in sorted(games.cold):
+        data = context.application.persistence.thaw(chat_id, label)
+        games.cold.discard(label)
+        if data is None:
+            logging.warning("Game %s of chat %s is missing in cold storage", label, chat_id)
+            continue
+        games.add(data, label)
+        metrics.inc('games_thawed_total')
+        if data.state == ST_TRACKING:
+            poller.subscribe(context.job_queue, chat_id, data)
+            turn_maker.resume(context.job_queue, chat_id, data)
+    context.application.mark_data_for_update_persistence(chat_ids=chat_id)
+
+
+def count_games_by_state(app: Application):
+    counts = {}
+    for chat_data in app.chat_data.values():
+        for data in chat_data.get('GAMES', ()):
+            key = (('state', data.state),)
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def resume_chat(app: Application, chat_id, chat_data):
+    """ picks up the tracking of the chat's games, e.g. after restart """
+    for data in chat_data.get('GAMES', ()):
+        if data.state == ST_TRACKING:
+            poller.subscribe(app.job_queue, chat_id, data)
+            turn_maker.resume(app.job_queue, chat_id, data)
+    if 'DIGEST' in chat_data:
+        digest.subscribe(chat_data['DIGEST'])
+
+
+def leave_chat(chat_id, chat_data):
+    """ stops all work for the chat, e.g. before another shard takes it over """
+    for data in chat_data.get('GAMES', ()):
+        stop_tracking(chat_id, data)
+    if 'DIGEST' in chat_data:
+        # the shard taking the chat over keeps the digest from now on
+        user = chat_data['DIGEST']
+        digest.unsubscribe(user.username, announce=False)
+        digest.subscribe_remote(user.username, user.user_id)
+
+
+async def resume_tracking(context: ContextTypes.DEFAULT_TYPE):
+    """
+    resumes games tracked before restart without asking the server: the poller spreads their
+    first polls over the poll interval and the first poll's result is taken as the baseline
+    """
+    app = context.application
+    started = time.perf_counter()
+    rows = app.persistence.rows_in_state(ST_TRACKING)
+    for i, (chat_id, blob) in enumerate(rows, 1):
+        chat_context = app.context_types.context(app, chat_id=chat_id)
+        app.persistence.adopt_chat(chat_id, blob, chat_context.chat_data)
+        resume_chat(app, chat_id, chat_context.chat_data)
+        if i % RESUME_BATCH == 0:
+            # let updates and polls in between
+            await asyncio.sleep(0)
+    logging.info("Resumed tracking %d chats in %.2f s", len(rows), time.perf_counter() - started)
+    for chat_id, blob in app.persistence.rows_with('DIGEST'):
+        chat_context = app.context_types.context(app, chat_id=chat_id)
+        app.persistence.adopt_chat(chat_id, blob, chat_context.chat_data)
+        digest.subscribe(chat_context.chat_data['DIGEST'])
+
+
+async def start_services(app: Application):
+    dispatcher.start(app.bot)
+    metrics.gauge('tracked_games', lambda: count_games_by_state(app))
+    metrics.gauge('game_server_circuit_open', count_open_circuits)
+    game_api.on_host_state = lambda host, available: report_host_state(app, host, available)
+    await metrics.start()
+    app.job_queue.run_repeating(sweep_messages, SWEEP_FREQUENCY, name="message sweeper")
+    app.job_queue.run_repeating(announce_progress, POLL_TICK, name="progress")
+    app.job_queue.run_repeating(send_digests, DIGEST_FREQUENCY, name="digests")
+    if app.persistence:
+        if saved := app.persistence.load_stats(FLEET_TURNS):
+            fleet_turns.merge(QuantileSketch.from_dict(saved))
+        app.job_queue.run_repeating(evict_games, EVICT_FREQUENCY, name="cold storage")
+        app.job_queue.run_repeating(save_turn_stats, app.persistence.update_interval, name="turn stats")
+    if recorder:
+        app.job_queue.run_repeating(flush_history, HISTORY_FLUSH_FREQUENCY, name="history flush")
+    if app.persistence:
+        app.job_queue.run_once(resume_tracking, 0, name="resume tracking")
+
+
+async def save_services(app: Application):
+    if app.persistence:
+        app.persistence.save_stats(FLEET_TURNS, fleet_turns.to_dict())
+
+
+async def stop_services(_: Application):
+    if recorder:
+        recorder.flush()
+    await metrics.stop()
+    await dispatcher.stop()
+    await game_api.close()
+
+
+def build_application(persistence, webhook=False) -> Application:
+    builder = Application.builder() \
         .token(TOKEN) \
-        .get_updates_http_version('1.1') \
         .http_version('1.1') \
         .persistence(persistence=persistence) \
-        .build()
+        .concurrent_updates(ChatOrderedProcessor(MAX_CONCURRENT_UPDATES)) \
+        .post_init(start_services) \
+        .post_stop(save_services) \
+        .post_shutdown(stop_services)
+    if webhook:
+        builder.updater(None).update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+    else:
+        builder.get_updates_http_version('1.1')
+    app = builder.build()
+
+    # before any other handler
+    app.add_handler(TypeHandler(Update, thaw_games), group=-1)
 
     msg_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), handle_msg)
     app.add_handler(msg_handler)
 
     app.add_handler(CommandHandler(["new"], new_game))
+    app.add_handler(CommandHandler(["tables"], new_tables))
     app.add_handler(CommandHandler(["start"], start))
     app.add_handler(CommandHandler(["pause"], pause))
     app.add_handler(CommandHandler(["restart", "unpause"], unpause))
+    app.add_handler(CommandHandler(["stop"], stop))
     app.add_handler(CommandHandler(["delay"], set_delay))
     app.add_handler(CommandHandler(["tagme"], turn_on_tagging))
     app.add_handler(CommandHandler(["tagmenot"], turn_off_tagging))
     app.add_handler(CommandHandler(["pass"], schedule_pass))
     app.add_handler(CommandHandler(["nopass"], unschedule_pass))
     app.add_handler(CommandHandler(["setlang"], set_lang))
-    app.run_polling()
+    app.add_handler(CommandHandler(["stats"], show_stats))
+    app.add_handler(CommandHandler(["turnstats"], show_turn_stats))
+    app.add_handler(CommandHandler(["digest"], toggle_digest))
+    return app
+
+
+def main():
+    if SHARDS:
+        from sharding import run_sharded
+        run_sharded(SHARDS)
+        return
+    persistence = SqlitePersistence(PERSISTENCE_FILE, update_interval=30)
+    import_pickle(persistence, LEGACY_PERSISTENCE_FILE)
+    app = build_application(persistence, webhook=RUN_MODE == RUN_WEBHOOK)
+    if RUN_MODE == RUN_WEBHOOK:
+        from webhook import run_webhook
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,157 @@
+import asyncio
+import bisect
+import time
+from contextlib import nullcontext
+from http import HTTPStatus
+
+from config import METRICS_ENABLED, METRICS_HOST, METRICS_PORT
+from http_server import Request, serve
+
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+enabled = METRICS_ENABLED
+port = METRICS_PORT  # shard processes listen on their own ports
+scrape_server = None
+lag_monitor = None
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """ upper bound of the bucket holding the q-th quantile """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Registry:
+    def __init__(self):
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # name -> callable returning {labels: value}
+
+    def histogram(self, name, labels) -> Histogram:
+        key = (name, labels)
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = Histogram()
+        return h
+
+    def render(self):
+        lines = []
+        for (name, labels), h in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(h.buckets + ('+Inf',), h.counts):
+                cumulative += count
+                lines.append(f'{series(name + "_bucket", labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{series(name + "_sum", labels)} {h.sum}')
+            lines.append(f'{series(name + "_count", labels)} {h.count}')
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f'{series(name, labels)} {value}')
+        for name, collect in sorted(self.gauges.items()):
+            for labels, value in sorted(collect().items()):
+                lines.append(f'{series(name, labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        lines = []
+        for (name, labels), h in sorted(self.histograms.items()):
+            if h.count:
+                lines.append(f'{series(name, labels)}: n={h.count} mean={h.sum / h.count:.3f}s '
+                             f'p50<={h.quantile(0.5)}s p99<={h.quantile(0.99)}s')
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f'{series(name, labels)}: {value}')
+        for name, collect in sorted(self.gauges.items()):
+            for labels, value in sorted(collect().items()):
+                lines.append(f'{series(name, labels)}: {value}')
+        return '\n'.join(lines) or "no data"
+
+
+def series(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+registry = Registry()
+
+
+def observe(name, value, **labels):
+    if enabled:
+        registry.histogram(name, tuple(sorted(labels.items()))).observe(value)
+
+
+def inc(name, **labels):
+    if enabled:
+        key = (name, tuple(sorted(labels.items())))
+        registry.counters[key] = registry.counters.get(key, 0) + 1
+
+
+def gauge(name, collect):
+    """ collect() returns {((label, value), ...): gauge value} and is called on scrape only """
+    registry.gauges[name] = collect
+
+
+class Timer:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+
+NOT_TIMED = nullcontext()
+
+
+def timed(name, **labels):
+    return Timer(name, labels) if enabled else NOT_TIMED
+
+
+async def monitor_loop_lag(interval=0.5):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        observe('event_loop_lag_seconds', time.perf_counter() - started - interval)
+
+
+async def handle_scrape(request: Request):
+    if request.path != '/metrics':
+        return HTTPStatus.NOT_FOUND, 'text/plain', b''
+    return HTTPStatus.OK, 'text/plain; version=0.0.4', registry.render().encode()
+
+
+async def start():
+    global scrape_server, lag_monitor
+    if enabled:
+        scrape_server = await serve(handle_scrape, METRICS_HOST, port)
+        lag_monitor = asyncio.create_task(monitor_loop_lag(), name="loop lag monitor")
+
+
+async def stop():
+    global scrape_server, lag_monitor
+    if lag_monitor:
+        lag_monitor.cancel()
+        lag_monitor = None
+    if scrape_server:
+        scrape_server.close()
+        scrape_server = None
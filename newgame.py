@@ -1,9 +1,14 @@
+import asyncio
+import copy
+import functools
 import json
 import logging
 import random
-import requests
+import time
+from typing import NamedTuple
 
-from config import DEFAULT_HOST
+from config import DEFAULT_HOST, TABLES_PARALLELISM
+from game_api import game_api
 
 
 ACCEPTED_COLORS = "red green blue yellow black purple orange pink".split()
@@ -20,6 +25,38 @@ ACCEPTED_OPTIONS = {
 }
 
 
+@functools.lru_cache(maxsize=1)
+def options_template():
+    """ default game parameters, read once """
+    with open('new_game_options.json') as fopts:
+        return json.load(fopts)
+
+
+def parse_options(text):
+    if text in ("", "дефолт"):
+        return {}
+    return {ACCEPTED_OPTIONS[t]: True for t in text.lower().split()}
+
+
+def make_game_params(players, options):
+    params = copy.deepcopy(options_template())
+    params.update(options)
+    params['seed'] = random.random()
+    params['players'] = [{
+        "index": idx + 1,
+        "name": name,
+        "color": color,
+        "beginner": False,
+        "handicap": 0,
+        "first": False,
+    } for idx, (name, color) in enumerate(players)]
+    return params
+
+
+def player_link(host, pid):
+    return f"http://{host}/player?id={pid}"
+
+
 class GameCreator:
     def __init__(self, num_players):
         self.num_players = num_players
@@ -30,6 +67,27 @@ class GameCreator:
         self.started = False
         self.game_id = None
 
+    def to_dict(self):
+        return {
+            'num_players': self.num_players,
+            'host': self.host,
+            'players': self.players,
+            'options': self.options,
+            'started': self.started,
+            'game_id': self.game_id,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        creator = cls(d['num_players'])
+        creator.host = d['host']
+        creator.players = [tuple(p) for p in d['players']]
+        creator.options = d['options']
+        creator.accepts_players = len(creator.players) < creator.num_players
+        creator.started = d['started']
+        creator.game_id = d['game_id']
+        return creator
+
     def add_player(self, player_name, color):
         if not self.accepts_players:
             raise RuntimeError()
@@ -46,7 +104,7 @@ class GameCreator:
             if text == "дефолт":
                 self.options = {}
             else:
-                self.options = {ACCEPTED_OPTIONS[t]: True for t in text.lower().split()}
+                self.options = parse_options(text)
         else:
             raise RuntimeError()
 
@@ -62,18 +120,17 @@ class GameCreator:
             "Доступные опции: {}".format(', '.join(ACCEPTED_OPTIONS.keys()))
         ])
 
-    @staticmethod
-    def player_link(pid):
-        return f"http://{DEFAULT_HOST}/player?id={pid}"
+    def player_link(self, pid):
+        return player_link(self.host, pid)
 
-    def get_message(self):
+    async def get_message(self):
         if self.accepts_players:
             return "Добавьте следующего игрока в формате <имя_игрока> <цвет>"
         elif self.options is None:
             return "Введите желаемые опции через пробел или слово \"дефолт\""
         elif len(self.players) > 0:
             self.started = True
-            reply = self.start_game()
+            reply = await self.start_game()
             self.game_id = reply["spectatorId"]
             return '\n'.join(["Игра создана"] + [
                 "{} {}".format(pl["name"], self.player_link(pl["id"])) for pl in reply["players"]
@@ -81,24 +138,74 @@ class GameCreator:
         else:
             raise RuntimeError()
 
-    def start_game(self):
-        start_url = f'http://{DEFAULT_HOST}/game'
-        with open('new_game_options.json') as fopts:
-            params = json.load(fopts)
-            params.update(self.options)
-            params['seed'] = random.random()
-            params['players'] = []
-            random.shuffle(self.players)
-            for idx, player in enumerate(self.players):
-                params['players'].append({
-                    "index": idx + 1,
-                    "name": player[0],
-                    "color": player[1],
-                    "beginner": False,
-                    "handicap": 0,
-                    "first": False,
-                })
-            logging.debug(params)
-            reply = requests.put(start_url, json=params)
-            logging.debug(reply.text)
-            return reply.json()
+    async def start_game(self):
+        random.shuffle(self.players)
+        params = make_game_params(self.players, self.options)
+        logging.debug(params)
+        reply = await game_api.create_game(self.host, params)
+        logging.debug(reply.text)
+        return reply.json()
+
+
+class CreatedTable(NamedTuple):
+    label: str
+    game_id: str  # spectator id, None if the game was not created
+    links: tuple  # ((player name, link), ...)
+    seconds: float
+    error: str
+
+
+TABLES_USAGE = '\n'.join([
+    "Использование:",
+    "/tables <опции через пробел или \"дефолт\">",
+    "<стол>: <имя_игрока> <цвет>, <имя_игрока> <цвет>, ...",
+    "<стол>: ...",
+])
+
+
+def parse_tables(text):
+    """ the /tables message: options on the first line, then one table per line; returns (options, tables) """
+    first, *lines = text.splitlines()
+    options = parse_options(first.partition(' ')[2].strip())
+    tables = []
+    for n, line in enumerate(filter(str.strip, lines), 1):
+        label, _, roster = line.rpartition(':')
+        players = []
+        for entry in roster.split(','):
+            name, color = entry.strip().rsplit(maxsplit=1)
+            if color not in ACCEPTED_COLORS:
+                raise ValueError(f"Неизвестный цвет {color}")
+            players.append((name, color))
+        tables.append((label.strip() or str(n), players))
+    if not tables or len({label for label, _ in tables}) != len(tables):
+        raise ValueError("Нужен хотя бы один стол, названия столов не должны повторяться")
+    return options, tables
+
+
+async def create_table(host, label, players, options, limit: asyncio.Semaphore) -> CreatedTable:
+    players = random.sample(players, len(players))
+    async with limit:
+        started = time.perf_counter()
+        try:
+            reply = (await game_api.create_game(host, make_game_params(players, options))).json()
+            links = tuple((pl["name"], player_link(host, pl["id"])) for pl in reply["players"])
+            game_id = reply["spectatorId"]
+        except Exception as e:
+            logging.exception("Failed to create table %s", label)
+            return CreatedTable(label, None, (), time.perf_counter() - started, table_error(e))
+    return CreatedTable(label, game_id, links, time.perf_counter() - started, None)
+
+
+def table_error(e: BaseException):
+    if isinstance(e, (KeyError, TypeError, ValueError)):
+        return "неожиданный ответ сервера"
+    return str(e) or type(e).__name__
+
+
+async def create_tables(host, options, tables):
+    """ creates the games of all tables, at most TABLES_PARALLELISM at once; a failed table does not stop the others """
+    limit = asyncio.Semaphore(TABLES_PARALLELISM)
+    created = await asyncio.gather(*(create_table(host, label, players, options, limit)
+                                     for label, players in tables), return_exceptions=True)
+    return [table if isinstance(table, CreatedTable) else CreatedTable(label, None, (), 0, table_error(table))
+            for (label, _), table in zip(tables, created)]
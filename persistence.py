@@ -0,0 +1,284 @@
+import asyncio
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import time
+import zlib
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import metrics
+from chat_games import ChatGames
+from constants import ST_WAIT_GAME_ID
+from digest import DigestUser
+from game_data import GameData
+from newgame import GameCreator
+
+
+CHAT_DATA_CODECS = {
+    # chat_data key -> (encode, decode)
+    'LANG': (lambda v: v, lambda v: v),
+    'GAMES': (ChatGames.to_dict, ChatGames.from_dict),
+    'CREATOR': (GameCreator.to_dict, GameCreator.from_dict),
+    'DIGEST': (DigestUser.to_dict, DigestUser.from_dict),
+}
+
+
+def encode_chat_data(chat_data) -> str:
+    return json.dumps({key: encode(chat_data[key])
+                       for key, (encode, _) in CHAT_DATA_CODECS.items() if key in chat_data},
+                      separators=(',', ':'))
+
+
+def decode_chat_data(blob) -> dict:
+    d = json.loads(blob)
+    if 'GAME' in d or 'TABLES' in d:
+        d = migrate_chat_data(d)
+    return {key: CHAT_DATA_CODECS[key][1](value) for key, value in d.items()}
+
+
+def migrate_chat_data(d):
+    """ chats used to have one game under GAME and the games made by /tables under TABLES """
+    d = dict(d)
+    game = d.pop('GAME', None)
+    games = list(d.pop('TABLES', {}).values())
+    waiting = False
+    if game is not None:
+        if game['state'] == ST_WAIT_GAME_ID:
+            waiting = True
+        elif game['game_id']:
+            games.insert(0, game)
+    d['GAMES'] = {'games': games, 'waiting': waiting}
+    return d
+
+
+class SqlitePersistence(BasePersistence):
+    """
+    Stores chat_data only, one row per chat, in a versioned JSON form rather than pickled classes.
+    A row is rewritten only when the chat's data actually changed, and chats are loaded lazily
+    on their first update after start. Games nobody needs for now are kept apart in cold storage,
+    compressed, and are read only when they are brought back.
+    """
+
+    def __init__(self, filepath, update_interval=60):
+        super().__init__(store_data=PersistenceInput(bot_data=False, user_data=False, callback_data=False),
+                         update_interval=update_interval)
+        self.db = sqlite3.connect(filepath)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS cold_games "
+                        "(chat_id INTEGER, label TEXT, data BLOB NOT NULL, PRIMARY KEY (chat_id, label))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self.db.commit()
+        self.saved = {}  # chat_id -> last written blob, for loaded chats only
+        self.batch_started = None  # when the first write not committed yet was made
+
+    def load_chat(self, chat_id):
+        row = self.db.execute("SELECT data FROM chat_data WHERE chat_id = ?", (chat_id,)).fetchone()
+        self.saved[chat_id] = row[0] if row else None
+        return decode_chat_data(row[0]) if row else {}
+
+    def rows_in_state(self, state):
+        """ rows of chats with a game in the given state, the others are not decoded """
+        return self.db.execute(
+            "SELECT chat_id, data FROM chat_data "
+            "WHERE EXISTS (SELECT 1 FROM json_each(data, '$.GAMES.games') WHERE json_extract(value, '$.state') = ?1) "
+            # rows not rewritten since chats had GAME and TABLES
+            "OR json_extract(data, '$.GAME.state') = ?1 "
+            "OR EXISTS (SELECT 1 FROM json_each(data, '$.TABLES') WHERE json_extract(value, '$.state') = ?1)",
+            (state,)).fetchall()
+
+    def rows_with(self, key):
+        """ rows of chats which have the chat_data key """
+        return self.db.execute("SELECT chat_id, data FROM chat_data WHERE json_type(data, '$.' || ?) IS NOT NULL",
+                               (key,)).fetchall()
+
+    def adopt_chat(self, chat_id, blob, chat_data):
+        """ loads a chat ahead of its first update, e.g. to resume tracking on start """
+        if chat_id not in self.saved:
+            self.saved[chat_id] = blob
+            chat_data.update(decode_chat_data(blob))
+
+    def unload(self, chat_id):
+        """ the chat's data is out of memory, its next update loads it again """
+        self.saved.pop(chat_id, None)
+
+    def freeze(self, chat_id, data: GameData):
+        blob = zlib.compress(json.dumps(data.to_dict(), separators=(',', ':')).encode())
+        self.db.execute("INSERT OR REPLACE INTO cold_games VALUES (?, ?, ?)", (chat_id, data.label, blob))
+        self.db.commit()
+
+    def thaw(self, chat_id, label) -> GameData:
+        """ the game as it was frozen, the cold copy stays until the chat's row no longer needs it """
+        row = self.db.execute("SELECT data FROM cold_games WHERE chat_id = ? AND label = ?",
+                              (chat_id, label)).fetchone()
+        return GameData.from_dict(json.loads(zlib.decompress(row[0]))) if row else None
+
+    def drop_cold(self, chat_id, label):
+        self.db.execute("DELETE FROM cold_games WHERE chat_id = ? AND label = ?", (chat_id, label))
+        self.db.commit()
+
+    def cold_rows(self, chat_ids):
+        return [row for chat_id in chat_ids
+                for row in self.db.execute("SELECT * FROM cold_games WHERE chat_id = ?", (chat_id,))]
+
+    def import_cold_rows(self, rows):
+        self.db.executemany("INSERT OR REPLACE INTO cold_games VALUES (?, ?, ?)", rows)
+        self.db.commit()
+
+    def load_stats(self, name):
+        row = self.db.execute("SELECT data FROM stats WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_stats(self, name, data):
+        """ bot-wide data kept apart from the chats, e.g. turn statistics of all games """
+        self.db.execute("INSERT OR REPLACE INTO stats VALUES (?, ?)", (name, json.dumps(data, separators=(',', ':'))))
+        self.db.commit()
+
+    def move_chat(self, chat_id, chat_data, filepath):
+        """ hands the chat over to the store in the file, together with its cold games """
+        target = SqlitePersistence(filepath)
+        target.import_rows([(chat_id, encode_chat_data(chat_data))])
+        target.import_cold_rows(self.cold_rows([chat_id]))
+        target.close()
+        self.delete_rows([chat_id])
+        self.unload(chat_id)
+
+    def is_empty(self):
+        return self.db.execute("SELECT 1 FROM chat_data LIMIT 1").fetchone() is None
+
+    def import_chat_data(self, chat_data: dict):
+        """ chat_data as PicklePersistence kept it, with the chat's only game under GAME """
+        rows = []
+        for chat_id, data in chat_data.items():
+            data = dict(data)
+            if (game := data.pop('GAME', None)) is not None:
+                games = data['GAMES'] = ChatGames()
+                if game.state == ST_WAIT_GAME_ID:
+                    games.waiting = True
+                elif game.game_id:
+                    games.add(game)
+            rows.append((chat_id, encode_chat_data(data)))
+        self.import_rows(rows)
+
+    def import_rows(self, rows):
+        self.db.executemany("INSERT OR REPLACE INTO chat_data VALUES (?, ?)", rows)
+        self.db.commit()
+
+    def all_rows(self):
+        return self.db.execute("SELECT chat_id, data FROM chat_data").fetchall()
+
+    def delete_rows(self, chat_ids):
+        chat_ids = [(chat_id,) for chat_id in chat_ids]
+        self.db.executemany("DELETE FROM chat_data WHERE chat_id = ?", chat_ids)
+        self.db.executemany("DELETE FROM cold_games WHERE chat_id = ?", chat_ids)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    async def get_chat_data(self):
+        return {}
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        if chat_id not in self.saved:
+            chat_data.update(self.load_chat(chat_id))
+
+    async def update_chat_data(self, chat_id, data):
+        if chat_id not in self.saved:
+            if data:
+                logging.warning("Not saving chat %s which was never loaded", chat_id)
+            # else the chat was unloaded
+            return
+        with metrics.timed('persistence_write_seconds'):
+            blob = encode_chat_data(data)
+            if blob == self.saved[chat_id]:
+                return
+            self.db.execute("INSERT OR REPLACE INTO chat_data VALUES (?, ?)", (chat_id, blob))
+        self.saved[chat_id] = blob
+        if self.batch_started is None:
+            self.batch_started = time.perf_counter()
+            # PTB writes all chats changed since its last run concurrently, they are committed at once
+            asyncio.get_running_loop().call_soon(self.commit_batch)
+
+    def commit_batch(self):
+        if self.batch_started is None:
+            return
+        self.db.commit()
+        metrics.observe('persistence_flush_seconds', time.perf_counter() - self.batch_started)
+        self.batch_started = None
+
+    async def drop_chat_data(self, chat_id):
+        self.db.execute("DELETE FROM chat_data WHERE chat_id = ?", (chat_id,))
+        self.db.execute("DELETE FROM cold_games WHERE chat_id = ?", (chat_id,))
+        self.db.commit()
+        self.saved[chat_id] = None
+
+    async def flush(self):
+        self.commit_batch()
+        self.db.commit()
+        self.close()
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+
+def read_stats(filepath, name):
+    """ stats saved by another process in its file, None if there are none yet """
+    try:
+        db = sqlite3.connect(f"file:{filepath}?mode=ro", uri=True)
+        try:
+            row = db.execute("SELECT data FROM stats WHERE name = ?", (name,)).fetchone()
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return None
+    return json.loads(row[0]) if row else None
+
+
+class _PickleImporter(pickle.Unpickler):
+    def persistent_load(self, pid):
+        return None
+
+
+def import_pickle(persistence: SqlitePersistence, filepath):
+    """ one-off migration from the PicklePersistence file used before """
+    if not os.path.exists(filepath) or not persistence.is_empty():
+        return
+    with open(filepath, 'rb') as f:
+        chat_data = _PickleImporter(f).load().get('chat_data', {})
+    persistence.import_chat_data(chat_data)
+    logging.info("Imported %d chats from %s", len(chat_data), filepath)
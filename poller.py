@@ -0,0 +1,183 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+
+from telegram.ext import Application, ContextTypes, JobQueue
+
+import metrics
+from chat_locks import chat_lock
+from config import UPDATE_FREQUENCY, POLL_TICK, POLL_MIN_INTERVAL, POLL_MAX_INTERVAL, POLL_JITTER
+from constants import PHASE_END, ST_FINISHED
+from snapshot import get_current_players
+
+
+class PolledGame:
+    def __init__(self, key):
+        self.key = key
+        self.chats = {}  # chat_id -> GameData
+        self.interval = UPDATE_FREQUENCY
+        self.due = None  # None while the game is being polled
+        self.players = None
+        self.turn_players = ()  # current players of the action phase when last seen, kept by the bot
+
+
+class GamePoller:
+    """
+    Owns all tracked games: fetches each game once per its poll interval and fans the status out
+    to every chat tracking it. The interval is short right after a turn change, grows
+    exponentially while the same player stays idle, and polling stops once the game is over.
+    Games of one chat due at the same tick are polled together and handled under one chat lock.
+    """
+
+    def __init__(self, fetch, handle, forget=None):
+        self.fetch = fetch  # async (host, game_id) -> (GameSnapshot, changed)
+        self.handle = handle  # async (context, chat_id, game_data, GameSnapshot)
+        self.forget = forget  # (host, game_id) -> None, called when the game is no longer polled
+        self.games = {}  # (host, game_id) -> PolledGame
+        self.chat_games = {}  # chat_id -> {(host, game_id), ...}
+        self.queue = []  # heap of (due, seq, key), entries with outdated due are skipped
+        self.seq = itertools.count()
+        self.job = None
+        self.clock = time.time
+        self.monotonic = time.monotonic
+
+    def subscribe(self, job_queue: JobQueue, chat_id, game_data):
+        """ starts polling the game for the chat, replacing the chat's previous GameData of that game """
+        key = (game_data.host, game_data.game_id)
+        self.chat_games.setdefault(chat_id, set()).add(key)
+        game = self.games.get(key)
+        if game is None:
+            game = self.games[key] = PolledGame(key)
+            # spread new games over the interval so they do not hit the server at once
+            self.schedule(game, random.uniform(0, UPDATE_FREQUENCY))
+        game.chats[chat_id] = game_data
+        if self.job is None:
+            self.job = job_queue.run_repeating(self.tick, POLL_TICK, name="poller")
+
+    def unsubscribe(self, chat_id, key=None):
+        """ stops polling the game for the chat, or all of the chat's games if no key is given """
+        keys = self.chat_games.get(chat_id, set())
+        for key in [key] if key is not None else list(keys):
+            if key not in keys:
+                continue
+            keys.discard(key)
+            game = self.games[key]
+            game.chats.pop(chat_id)
+            if not game.chats:
+                self.drop(game)
+        if not keys:
+            self.chat_games.pop(chat_id, None)
+
+    def drop(self, game: PolledGame):
+        self.games.pop(game.key)
+        if self.forget:
+            self.forget(*game.key)
+
+    def schedule(self, game: PolledGame, delay):
+        game.due = self.monotonic() + delay
+        heapq.heappush(self.queue, (game.due, next(self.seq), game.key))
+
+    async def tick(self, context: ContextTypes.DEFAULT_TYPE):
+        for games in self.due_batches(self.monotonic()):
+            context.application.create_task(self.poll(context.application, games),
+                                            name="poll {} {}".format(*games[0].key))
+
+    def due_games(self, now):
+        """ yields games due by now, each stays out of the queue until it is rescheduled """
+        while self.queue and self.queue[0][0] <= now:
+            due, _, key = heapq.heappop(self.queue)
+            game = self.games.get(key)
+            if game is None or game.due != due:
+                continue
+            game.due = None
+            yield game
+
+    def due_batches(self, now):
+        """ due games grouped by a chat tracking them, so that a chat handles its due games at once """
+        batches = {}
+        for game in self.due_games(now):
+            batches.setdefault(next(iter(game.chats)), []).append(game)
+        return list(batches.values())
+
+    async def poll(self, application: Application, games):
+        results = [(None, False)] * len(games)
+        started = time.perf_counter()
+        try:
+            if len(games) == 1:
+                results = [await self.fetch(*games[0].key)]
+            else:
+                results = await asyncio.gather(*(self.fetch(*game.key) for game in games))
+            updates = {}  # chat_id -> [(game_data, status)]
+            for game, (status, changed) in zip(games, results):
+                if not status:
+                    continue
+                for chat_id, data in game.chats.items():
+                    # without changes in the game only delayed pings may be due
+                    if changed or data.last_ping != game.players:
+                        updates.setdefault(chat_id, []).append((data, status))
+            if updates:
+                await self.fan_out(application, updates)
+        finally:
+            for game, (status, _) in zip(games, results):
+                if self.games.get(game.key) is game:
+                    self.reschedule(game, status)
+            metrics.observe('poll_seconds', time.perf_counter() - started)
+
+    async def fan_out(self, application: Application, updates):
+        # chats are handled concurrently, so a chat busy with a slow command does not delay the others
+        if len(updates) == 1:
+            await self.handle_chat(application, *next(iter(updates.items())))
+        else:
+            await asyncio.gather(*(self.handle_chat(application, chat_id, chat_updates)
+                                   for chat_id, chat_updates in updates.items()))
+        application.mark_data_for_update_persistence(chat_ids=list(updates))
+
+    async def handle_chat(self, application: Application, chat_id, updates):
+        chat_context = application.context_types.context(application, chat_id=chat_id)
+        async with chat_lock(chat_id):
+            for game_data, status in updates:
+                game = self.games.get((game_data.host, game_data.game_id))
+                if game is None or game.chats.get(chat_id) is not game_data:
+                    # the chat unsubscribed or switched games while waiting for the lock
+                    continue
+                try:
+                    await self.handle(chat_context, chat_id, game_data, status)
+                except Exception:
+                    logging.exception("Failed to handle status for chat %s", chat_id)
+
+    def reschedule(self, game: PolledGame, status):
+        if not status:
+            self.schedule(game, game.interval)
+            return
+        if status.phase == PHASE_END:
+            self.finish(game)
+            return
+        try:
+            players = get_current_players(status)
+        except RuntimeError:
+            players = ()
+        if players != game.players:
+            game.players = players
+            game.interval = POLL_MIN_INTERVAL
+        else:
+            game.interval = min(game.interval * 2, POLL_MAX_INTERVAL)
+        delay = game.interval
+        # wake up in time for delayed pings which are still to be sent
+        waiting = [data.ping_delay_min for data in game.chats.values() if data.last_ping != players]
+        if players and waiting:
+            ping_at = max(p[1] for p in players) / 1000 + min(waiting) * 60
+            delay = min(delay, max(ping_at - self.clock(), POLL_MIN_INTERVAL))
+        self.schedule(game, delay * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER))
+
+    def finish(self, game: PolledGame):
+        logging.info("Game %s at %s is over, stop polling it", game.key[1], game.key[0])
+        for chat_id, game_data in game.chats.items():
+            game_data.state = ST_FINISHED
+            keys = self.chat_games[chat_id]
+            keys.discard(game.key)
+            if not keys:
+                del self.chat_games[chat_id]
+        self.drop(game)
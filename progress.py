@@ -0,0 +1,184 @@
+import math
+from typing import NamedTuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from snapshot import GameSnapshot
+
+
+TRACKS = (
+    # global parameter: (min, max)
+    ('oceans', 0, 9),
+    ('oxygen', 0, 14),
+    ('temperature', -30, 8),
+    ('venus', 0, 30),
+    ('moon_habitat', 0, 8),
+    ('moon_mining', 0, 8),
+    ('moon_logistics', 0, 8),
+)
+LOW = [low for _, low, _ in TRACKS]
+SPAN = [high - low for _, low, high in TRACKS]
+
+
+class Crossing(NamedTuple):
+    """ a game whose terraforming went over a 10% threshold """
+    key: tuple
+    owner: object
+    status: GameSnapshot
+    percent: int
+    generations_left: int  # at the pace seen so far, None while it is unknown
+
+
+def track_values(status: GameSnapshot):
+    """ values and weights of TRACKS, only the tracks the end of the game depends on count """
+    values = [status.oceans, status.oxygen, status.temperature, 0, 0, 0, 0]
+    weights = [1.0, 1.0, 1.0, 0.0, 0.0, 0.0, 0.0]
+    if status.venus is not None:
+        values[3] = status.venus
+        weights[3] = float(status.venus_required)
+    if status.moon is not None:
+        values[4:7] = status.moon
+        weights[4:7] = [float(status.moon_required)] * 3
+    return values, weights
+
+
+class ProgressEngine:
+    """
+    Terraforming progress of all polled games, kept in columns with a row per game. Polls only write
+    the changed games' rows; one pass per tick recomputes the progress of every game at once, finds
+    the games which crossed a 10% threshold and forecasts their remaining generations from the pace
+    since they were first seen. The columns are numpy arrays if numpy is installed, lists otherwise.
+    """
+
+    COLUMNS = (
+        # name, initial value, shape of a row
+        ('values', 0.0, (len(TRACKS),)),
+        ('weights', 0.0, (len(TRACKS),)),
+        ('generation', 0.0, ()),
+        ('first_generation', math.nan, ()),
+        ('first_progress', math.nan, ()),
+        ('announced', -1.0, ()),  # tens of percent last reported
+    )
+
+    def __init__(self, capacity=1024):
+        self.rows = {}  # (host, game_id) -> row
+        self.keys = []  # row -> (host, game_id), None for unused rows
+        self.owners = []  # row -> what the caller wants back with the game's crossings
+        self.statuses = []  # row -> GameSnapshot
+        self.free = []  # unused rows
+        self.dropped = []  # rows forgotten since the last pass, still to be looked at by it
+        self.changed = False  # rows were written since the last pass
+        self.capacity = 0
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        added = capacity - self.capacity
+        if np is not None:
+            for name, value, shape in self.COLUMNS:
+                new = np.full((capacity,) + shape, value, dtype=np.float64)
+                if self.capacity:
+                    new[:self.capacity] = getattr(self, name)
+                setattr(self, name, new)
+        else:
+            for name, value, shape in self.COLUMNS:
+                if not self.capacity:
+                    setattr(self, name, [])
+                getattr(self, name).extend([value] * len(TRACKS) if shape else value for _ in range(added))
+        self.capacity = capacity
+
+    def observe(self, key, status: GameSnapshot, owner):
+        row = self.rows.get(key)
+        if row is None:
+            row = self.add(key)
+        self.owners[row] = owner
+        self.statuses[row] = status
+        self.values[row], self.weights[row] = track_values(status)
+        self.generation[row] = status.generation or 0
+        self.changed = True
+
+    def add(self, key):
+        if self.free:
+            row = self.free.pop()
+        else:
+            row = len(self.keys)
+            if row == self.capacity:
+                self.grow(self.capacity * 2)
+            self.keys.append(None)
+            self.owners.append(None)
+            self.statuses.append(None)
+        self.keys[row] = key
+        self.rows[key] = row
+        self.first_generation[row] = self.first_progress[row] = math.nan
+        self.announced[row] = -1
+        return row
+
+    def forget(self, key):
+        """ the game's last crossing is still reported by the next pass """
+        row = self.rows.pop(key, None)
+        if row is not None:
+            self.dropped.append(row)
+
+    def crossings(self):
+        """ recomputes the progress of all games, returns those which crossed a 10% threshold since the last pass """
+        n = len(self.keys)
+        if not self.changed:
+            return []
+        self.changed = False
+        found = self.pass_numpy(n) if np is not None else self.pass_python(n)
+        result = [Crossing(self.keys[row], self.owners[row], self.statuses[row], percent, left)
+                  for row, percent, left in found]
+        for row in self.dropped:
+            self.keys[row] = self.owners[row] = self.statuses[row] = None
+            self.weights[row] = [0.0] * len(TRACKS)
+            self.free.append(row)
+        self.dropped = []
+        return result
+
+    def pass_numpy(self, n):
+        weights = self.weights[:n]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # unused rows have no weights, so their progress is nan and they never cross anything
+            progress = ((self.values[:n] - LOW) / SPAN * weights).sum(axis=1) / weights.sum(axis=1) * 100
+            generation = self.generation[:n]
+            first = np.isnan(self.first_progress[:n])
+            self.first_progress[:n][first] = progress[first]
+            self.first_generation[:n][first] = generation[first]
+            percent = np.round(progress)
+            decile = percent // 10
+            crossed = np.flatnonzero(decile > self.announced[:n])
+            self.announced[crossed] = decile[crossed]
+            rate = ((progress[crossed] - self.first_progress[crossed])
+                    / (generation[crossed] - self.first_generation[crossed]))
+            left = np.ceil((100 - progress[crossed]) / rate)
+        known = (rate > 0) & (left > 0)
+        return [(row, int(p), int(g) if k else None)
+                for row, p, g, k in zip(crossed.tolist(), percent[crossed].tolist(), left.tolist(), known.tolist())]
+
+    def pass_python(self, n):
+        found = []
+        for row in range(n):
+            weights = self.weights[row]
+            counted = sum(weights)
+            if not counted:
+                continue
+            total = 0.0
+            for value, low, span, weight in zip(self.values[row], LOW, SPAN, weights):
+                total += (value - low) / span * weight
+            progress = total / counted * 100
+            generation = self.generation[row]
+            if math.isnan(self.first_progress[row]):
+                self.first_progress[row] = progress
+                self.first_generation[row] = generation
+            percent = round(progress)
+            if percent // 10 <= self.announced[row]:
+                continue
+            self.announced[row] = percent // 10
+            left = None
+            if generation > self.first_generation[row] and progress > self.first_progress[row]:
+                rate = (progress - self.first_progress[row]) / (generation - self.first_generation[row])
+                left = math.ceil((100 - progress) / rate) or None
+            found.append((row, percent, left))
+        return found
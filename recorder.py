@@ -0,0 +1,290 @@
+"""
+Game history: every change of a tracked game is appended to its own log file, delta-encoded
+against the previous state, so a game of a few hundred turns takes a few kilobytes.
+
+    python recorder.py [history dir]
+
+prints a summary of every recorded game.
+"""
+import mmap
+import os
+import sys
+import time
+from typing import NamedTuple
+from urllib.parse import quote, unquote
+
+from config import HISTORY_DIR
+from snapshot import GameSnapshot
+
+
+LOG_SUFFIX = ".tmlog"
+
+# a record is a varint length and a payload of a varint field mask, a varint number of seconds since
+# the previous record (absolute for the first record of a segment) and the fields set in the mask;
+# strings are written once per segment and referred to by their index after that
+F_PHASE = 1
+F_PLAYERS = 2  # current players: count, then name and zigzag delta of the turn start in ms for each
+F_OCEANS = 4
+F_OXYGEN = 8
+F_TEMPERATURE = 16  # zigzag
+F_GENERATION = 32
+F_NAMES = 64  # all player names: count, then names
+F_AGE = 128
+# a record without fields starts a new segment: every (re)start of the bot begins one, so a writer
+# never has to read the file back to know the state its deltas are based on
+SEGMENT = 0
+
+
+class HistoryEntry(NamedTuple):
+    time: int  # unix time the change was seen at, seconds
+    phase: str
+    current_players: tuple  # ((name, timer started at, ms), ...)
+    oceans: int
+    oxygen: int
+    temperature: int
+    generation: int
+    player_names: tuple
+    game_age: int
+
+
+EMPTY_ENTRY = HistoryEntry(0, None, (), 0, 0, 0, 0, (), 0)
+
+
+def write_varint(out: bytearray, value):
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def zigzag(value):
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+class LogEncoder:
+    """ encodes the changes of one game against the previous state written in the current segment """
+
+    def __init__(self):
+        self.strings = {}
+        self.last = None
+        self.last_started = 0
+
+    def string(self, out: bytearray, s):
+        index = self.strings.get(s)
+        if index is not None:
+            write_varint(out, index)
+            return
+        write_varint(out, len(self.strings))
+        self.strings[s] = len(self.strings)
+        raw = s.encode()
+        write_varint(out, len(raw))
+        out += raw
+
+    def encode(self, entry: HistoryEntry) -> bytes:
+        """ returns the record, empty if nothing changed """
+        out = bytearray()
+        last = self.last
+        if last is None:
+            out.append(1)
+            write_varint(out, SEGMENT)
+            last = EMPTY_ENTRY
+        # the clock may be set back, times are kept non-decreasing
+        entry = entry._replace(time=max(entry.time, last.time))
+        payload = bytearray()
+        mask = 0
+        if entry.phase != last.phase:
+            mask |= F_PHASE
+            self.string(payload, entry.phase)
+        if entry.current_players != last.current_players:
+            mask |= F_PLAYERS
+            write_varint(payload, len(entry.current_players))
+            for name, started in entry.current_players:
+                self.string(payload, name)
+                write_varint(payload, zigzag(started - self.last_started))
+                self.last_started = started
+        for flag, value, previous, signed in (
+                (F_OCEANS, entry.oceans, last.oceans, False),
+                (F_OXYGEN, entry.oxygen, last.oxygen, False),
+                (F_TEMPERATURE, entry.temperature, last.temperature, True),
+                (F_GENERATION, entry.generation, last.generation, False)):
+            if value != previous:
+                mask |= flag
+                write_varint(payload, zigzag(value) if signed else value)
+        if entry.player_names != last.player_names:
+            mask |= F_NAMES
+            write_varint(payload, len(entry.player_names))
+            for name in entry.player_names:
+                self.string(payload, name)
+        if entry.game_age != last.game_age:
+            mask |= F_AGE
+            write_varint(payload, entry.game_age)
+        if not mask:
+            return bytes(out)
+        head = bytearray()
+        write_varint(head, mask)
+        write_varint(head, entry.time - last.time)
+        write_varint(out, len(head) + len(payload))
+        out += head + payload
+        self.last = entry
+        return bytes(out)
+
+
+class LogDecoder:
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+        self.strings = []
+        self.last = EMPTY_ENTRY
+        self.last_started = 0
+
+    def varint(self):
+        result = shift = 0
+        while True:
+            byte = self.buf[self.pos]
+            self.pos += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def string(self):
+        index = self.varint()
+        if index == len(self.strings):
+            length = self.varint()
+            self.strings.append(bytes(self.buf[self.pos:self.pos + length]).decode())
+            self.pos += length
+        return self.strings[index]
+
+    def __iter__(self):
+        size = len(self.buf)
+        while self.pos < size:
+            try:
+                length = self.varint()
+                end = self.pos + length
+                if end > size:
+                    # the bot stopped in the middle of writing the record
+                    return
+                entry = self.record()
+            except IndexError:
+                return
+            self.pos = end
+            if entry is not None:
+                yield entry
+
+    def record(self):
+        mask = self.varint()
+        if mask == SEGMENT:
+            self.strings = []
+            self.last = EMPTY_ENTRY
+            self.last_started = 0
+            return None
+        last = self.last
+        changes = {'time': last.time + self.varint()}
+        if mask & F_PHASE:
+            changes['phase'] = self.string()
+        if mask & F_PLAYERS:
+            players = []
+            for _ in range(self.varint()):
+                name = self.string()
+                self.last_started += unzigzag(self.varint())
+                players.append((name, self.last_started))
+            changes['current_players'] = tuple(players)
+        if mask & F_OCEANS:
+            changes['oceans'] = self.varint()
+        if mask & F_OXYGEN:
+            changes['oxygen'] = self.varint()
+        if mask & F_TEMPERATURE:
+            changes['temperature'] = unzigzag(self.varint())
+        if mask & F_GENERATION:
+            changes['generation'] = self.varint()
+        if mask & F_NAMES:
+            changes['player_names'] = tuple(self.string() for _ in range(self.varint()))
+        if mask & F_AGE:
+            changes['game_age'] = self.varint()
+        self.last = last._replace(**changes)
+        return self.last
+
+
+def log_path(directory, host, game_id):
+    return os.path.join(directory, quote(host, safe=''), quote(game_id, safe='') + LOG_SUFFIX)
+
+
+class HistoryRecorder:
+    """ buffers encoded changes in memory and appends them to the game logs on flush() """
+
+    def __init__(self, directory=HISTORY_DIR):
+        self.directory = directory
+        self.encoders = {}  # (host, game_id) -> LogEncoder
+        self.pending = {}  # (host, game_id) -> bytearray
+
+    def record(self, host, game_id, snapshot: GameSnapshot, now=None):
+        key = (host, game_id)
+        encoder = self.encoders.get(key)
+        if encoder is None:
+            encoder = self.encoders[key] = LogEncoder()
+        entry = HistoryEntry(
+            time=int(now if now is not None else time.time()),
+            phase=snapshot.phase,
+            current_players=snapshot.current_players,
+            oceans=snapshot.oceans,
+            oxygen=snapshot.oxygen,
+            temperature=snapshot.temperature,
+            generation=snapshot.generation or 0,
+            player_names=snapshot.player_names,
+            game_age=snapshot.game_age or 0,
+        )
+        if record := encoder.encode(entry):
+            self.pending.setdefault(key, bytearray()).extend(record)
+
+    def forget(self, host, game_id):
+        self.encoders.pop((host, game_id), None)
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        for (host, game_id), data in pending.items():
+            path = log_path(self.directory, host, game_id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'ab') as f:
+                f.write(data)
+
+
+def read_log(path):
+    """ yields HistoryEntry for every recorded change of the game """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            yield from LogDecoder(buf)
+
+
+def scan(directory=HISTORY_DIR):
+    """ yields (host, game_id, path) for every game log in the directory """
+    for host_dir in sorted(os.scandir(directory), key=lambda e: e.name):
+        if not host_dir.is_dir():
+            continue
+        for entry in sorted(os.scandir(host_dir.path), key=lambda e: e.name):
+            if entry.name.endswith(LOG_SUFFIX):
+                yield unquote(host_dir.name), unquote(entry.name[:-len(LOG_SUFFIX)]), entry.path
+
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else HISTORY_DIR
+    games = changes = size = 0
+    for host, game_id, path in scan(directory):
+        entries = list(read_log(path))
+        games += 1
+        changes += len(entries)
+        size += os.path.getsize(path)
+        if entries:
+            first, last = entries[0], entries[-1]
+            print(f"{host} {game_id}: {len(entries)} changes over {(last.time - first.time) / 3600:.1f} h, "
+                  f"generation {last.generation}, phase {last.phase}, {os.path.getsize(path)} bytes")
+    print(f"{games} games, {changes} changes, {size} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""
+Offline replay of the tracking pipeline: recorded (see recorder.py) or generated game timelines are
+polled by the real GamePoller and handled by the real process_status on a virtual clock, with a stub
+Telegram sender, so days of games take seconds.
+
+    python replay.py history/                       replay all recorded games
+    python replay.py --synthetic 1000 --passes 1    replay generated games, first player always passes
+    python replay.py ... --save golden.txt          write the produced messages
+    python replay.py ... --expect golden.txt        fail if the produced messages differ
+    python replay.py --check                        compare generated games with REPLAY_GOLDEN kept in the repo
+"""
+import argparse
+import asyncio
+import difflib
+import itertools
+import os
+import random
+import sys
+import time
+
+from telegram.ext import Application
+
+import main
+from chat_games import ChatGames
+from config import TOKEN, DEFAULT_DELAY
+from constants import PHASE_DRAFTING, PHASE_RESEARCH, PHASE_END, ST_TRACKING, TURN_PASS
+from game_data import GameData
+from poller import GamePoller
+from recorder import read_log, scan
+from snapshot import GameSnapshot
+
+
+REPLAY_GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "replay_golden.txt")
+# regenerate with the same arguments and --save after an intended change of the bot's messages
+CHECK_ARGS = ['--synthetic', '25', '--passes', '1', '--seed', '1', '--expect', REPLAY_GOLDEN]
+
+
+REPLAY_HOST = "replay"
+
+
+class VirtualClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class StubMessage:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+
+class StubSender:
+    """ stands in for MessageDispatcher and logs what would be sent """
+
+    def __init__(self, clock: VirtualClock):
+        self.clock = clock
+        self.start = clock.now
+        self.log = []  # (seconds since start, chat_id, kind, text)
+        self.message_ids = itertools.count(1)
+
+    def send(self, chat_id, text, priority=None, on_sent=None, **kwargs):
+        self.deliver('send', chat_id, text, on_sent)
+
+    def ping(self, chat_id, text, on_sent=None, **kwargs):
+        self.deliver('ping', chat_id, text, on_sent)
+
+    def delete(self, chat_id, message_ids):
+        self.log.append((self.clock.now - self.start, chat_id, 'delete', ' '.join(map(str, message_ids))))
+
+    def deliver(self, kind, chat_id, text, on_sent):
+        self.log.append((self.clock.now - self.start, chat_id, kind, text))
+        if on_sent:
+            on_sent(StubMessage(next(self.message_ids)))
+
+    def lines(self):
+        return [f"{int(t):>9} {chat_id} {kind} {text}" for t, chat_id, kind, text in self.log]
+
+
+class ReplayedGame:
+    def __init__(self, chat_id, game_id, timeline, passers):
+        self.chat_id = chat_id
+        self.game_id = game_id
+        self.timeline = timeline  # [(unix time, GameSnapshot)], ordered by time
+        self.passers = passers  # in-game names of players who /pass every generation
+        self.pos = -1
+        self.skipped = False
+        self.pass_generation = None
+
+    def at(self, now):
+        """ returns (snapshot, changed) as the game server would at the given time """
+        pos = self.pos
+        while pos + 1 < len(self.timeline) and self.timeline[pos + 1][0] <= now:
+            pos += 1
+        changed, self.pos = pos != self.pos or self.skipped, pos
+        self.skipped = False
+        return (self.timeline[pos][1] if pos >= 0 else None), changed
+
+    def skip_turn(self):
+        """ the current player passed, so their turn is over before the recorded one was """
+        if self.pos + 1 < len(self.timeline):
+            self.pos += 1
+            self.skipped = True
+
+    @property
+    def end(self):
+        return self.timeline[-1][0]
+
+
+def log_timeline(path):
+    return [(entry.time, GameSnapshot(
+        phase=entry.phase,
+        current_players=entry.current_players,
+        oceans=entry.oceans,
+        oxygen=entry.oxygen,
+        temperature=entry.temperature,
+        player_names=entry.player_names,
+        game_age=entry.game_age,
+        undo_count=0,
+        generation=entry.generation,
+    )) for entry in read_log(path)]
+
+
+def synthetic_timeline(rng: random.Random, start, players, turn_minutes):
+    """ a game with drafting, research and action phases, which ends when Mars is terraformed """
+    names = tuple(f"Player{k}" for k in range(players))
+    t = start
+    age = 0
+    oceans, oxygen, temperature = 0, 0, -30
+    timeline = []
+
+    def add(phase, current, generation):
+        nonlocal age
+        age += 1
+        timeline.append((t, GameSnapshot(phase, tuple((name, t * 1000) for name in current), oceans, oxygen,
+                                          temperature, names, age, 0, generation)))
+
+    def turn_length():
+        return int(rng.expovariate(1 / (turn_minutes * 60))) + 1
+
+    for generation in itertools.count(1):
+        if generation > 1:
+            add(PHASE_DRAFTING, names, generation)
+            t += turn_length()
+            add(PHASE_RESEARCH, names, generation)
+            t += turn_length()
+        for turn in range(players * rng.randint(2, 5)):
+            add('action', (names[(generation + turn) % players],), generation)
+            t += turn_length()
+            step = rng.randrange(6)
+            if step == 0 and oceans < 9:
+                oceans += 1
+            elif step == 1 and oxygen < 14:
+                oxygen += 1
+            elif step == 2 and temperature < 8:
+                temperature += 2
+        if (oceans, oxygen, temperature) == (9, 14, 8):
+            add(PHASE_END, (), generation)
+            return timeline
+
+
+class Replay:
+    def __init__(self, games, delay_min):
+        self.clock = VirtualClock(min(game.timeline[0][0] for game in games))
+        self.sender = StubSender(self.clock)
+        self.app = Application.builder().token(TOKEN).updater(None).build()
+        self.poller = GamePoller(self.fetch, self.handle)
+        self.poller.clock = self.poller.monotonic = self.clock
+        self.context = self.app.context_types.context(self.app)
+        self.games = {}
+        self.polls = 0
+        for game in games:
+            self.games[(REPLAY_HOST, game.game_id)] = game
+            context = self.app.context_types.context(self.app, chat_id=game.chat_id)
+            games = context.chat_data['GAMES'] = ChatGames()
+            data = games.add(GameData(ST_TRACKING, host=REPLAY_HOST, game_id=game.game_id))
+            data.ping_delay_min = delay_min
+            for name in game.passers:
+                games.set_player(data, f"user_{name}", name, f"id_{name}")
+            self.poller.subscribe(self, game.chat_id, data)
+
+    def run_repeating(self, *args, **kwargs):
+        """ the poller's job is never started, run() calls it instead """
+
+    async def fetch(self, host, game_id):
+        self.polls += 1
+        status, changed = self.games[(host, game_id)].at(self.clock.now)
+        if changed:
+            main.observe_change((host, game_id), status, self.poller.games.get((host, game_id)))
+        return status, changed
+
+    async def handle(self, context, chat_id, data: GameData, status: GameSnapshot):
+        game = self.games[(data.host, data.game_id)]
+        in_action = status.phase not in (PHASE_DRAFTING, PHASE_RESEARCH, PHASE_END)
+        if in_action and game.passers and status.generation != game.pass_generation:
+            game.pass_generation = status.generation
+            for name in game.passers:
+                data.player_by_name(name).action = TURN_PASS
+        await main.process_status(context, chat_id, data, status)
+        players = status.current_players
+        if in_action and len(players) == 1 and main.turn_maker.is_pending(data, players[0][0]):
+            await main.turn_maker.passed(self.app, chat_id, data, data.player_by_name(players[0][0]).username)
+            game.skip_turn()
+
+    async def run(self):
+        """ polls the games until they end or their timelines are over, returns the virtual time span """
+        start = self.clock.now
+        end = max(game.end for game in self.games.values())
+        main.clock = self.clock
+        main.dispatcher = self.sender
+        while self.poller.queue:
+            now = self.poller.queue[0][0]
+            if now > end:
+                break
+            self.clock.now = now
+            for games in self.poller.due_batches(now):
+                await self.poller.poll(self.app, games)
+            await main.announce_progress(self.context)
+        return self.clock.now - start
+
+
+def load_games(args, rng: random.Random):
+    games = []
+    paths = []
+    for path in args.logs:
+        if os.path.isdir(path):
+            paths.extend(p for _, _, p in scan(path))
+        else:
+            paths.append(path)
+    for path in paths:
+        timeline = log_timeline(path)
+        if timeline:
+            names = timeline[0][1].player_names
+            games.append(ReplayedGame(len(games) + 1, path, timeline, names[:args.passes]))
+    start = int(time.time())
+    for k in range(args.synthetic):
+        timeline = synthetic_timeline(rng, start + rng.randrange(3600), args.players, args.turn_minutes)
+        games.append(ReplayedGame(len(games) + 1, f"synthetic{k}", timeline,
+                                  timeline[0][1].player_names[:args.passes]))
+    return games
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('logs', nargs='*', help="game logs or directories with them")
+    parser.add_argument('--synthetic', type=int, default=0, help="generated games to replay")
+    parser.add_argument('--players', type=int, default=4, help="players in generated games")
+    parser.add_argument('--turn-minutes', type=float, default=20, help="mean turn length in generated games")
+    parser.add_argument('--passes', type=int, default=0, help="players in each game with /pass every generation")
+    parser.add_argument('--delay', type=int, default=DEFAULT_DELAY, help="ping delay, minutes")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help="write the produced messages to this file")
+    parser.add_argument('--expect', help="compare the produced messages with this file")
+    parser.add_argument('--check', action='store_true', help="replay the games of the kept golden file")
+    args = parser.parse_args()
+    if args.check:
+        args = parser.parse_args(CHECK_ARGS)
+    return args
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    # poll jitter comes from the random module
+    random.seed(args.seed)
+    games = load_games(args, rng)
+    if not games:
+        sys.exit("Nothing to replay, give game logs or --synthetic N")
+    replay = Replay(games, args.delay)
+    started = time.perf_counter()
+    span = asyncio.run(replay.run())
+    wall = time.perf_counter() - started
+    lines = replay.sender.lines()
+    print(f"{len(games)} games, {replay.polls} polls, {len(lines)} messages, "
+          f"{span / 3600:.1f} h replayed in {wall:.2f} s ({span / wall:.0f}x), "
+          f"{wall / max(replay.polls, 1) * 1e6:.0f} us per poll")
+    if args.save:
+        with open(args.save, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+    if args.expect:
+        with open(args.expect) as f:
+            expected = f.read().splitlines()
+        diff = list(difflib.unified_diff(expected, lines, args.expect, 'replay', lineterm=''))
+        if diff:
+            print('\n'.join(diff[:50]))
+            sys.exit(1)
+        print("Messages match", args.expect)
+
+
+if __name__ == "__main__":
+    run(parse_args())
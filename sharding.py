@@ -0,0 +1,285 @@
+"""
+Sharded mode: tracked games are split across SHARDS worker processes by a stable hash of
+(host, game_id). A chat's data and all its games stay together on the shard of the chat's first
+game, and the chat moves to another shard when its first game changes. The front process
+receives Telegram updates and forwards each one to the shard owning its chat; every shard runs
+the usual bot with its own persistence file.
+"""
+import asyncio
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import zlib
+
+from telegram import Update
+from telegram.ext import Application, ApplicationHandlerStop, ContextTypes, TypeHandler
+
+from config import (TOKEN, LOG_NAME, PERSISTENCE_FILE, LEGACY_PERSISTENCE_FILE, RUN_MODE, UPDATE_QUEUE_SIZE,
+                    TG_GLOBAL_RATE, TG_GLOBAL_BURST)
+from constants import RUN_WEBHOOK, FLEET_TURNS
+from chat_locks import chat_lock
+from lifecycle import running
+from persistence import SqlitePersistence, import_pickle
+from turn_stats import QuantileSketch
+
+
+def shard_of(key, shards):
+    return zlib.crc32(key.encode()) % shards
+
+
+def owner_key(chat_id, first_game=None):
+    """ chats with games are owned by the shard of their first game, others by the chat's one """
+    if first_game:
+        return "{}/{}".format(*first_game)
+    return f"chat/{chat_id}"
+
+
+def first_game(blob):
+    """ (host, game_id) of the first game in the chat's persisted row, None if it has none """
+    data = json.loads(blob)
+    games = data['GAMES']['games'] if 'GAMES' in data else [data.get('GAME')]
+    game = games[0] if games else None
+    if game and game.get('host') and game.get('game_id'):
+        return game['host'], game['game_id']
+    return None
+
+
+def shard_file(index):
+    root, ext = os.path.splitext(PERSISTENCE_FILE)
+    return f"{root}-shard{index}{ext}"
+
+
+def rebalance(shards):
+    """ moves persisted chats to the shards owning them for the current number of shards, returns chat -> shard """
+    stores = [SqlitePersistence(shard_file(i)) for i in range(shards)]
+    sources = [(path, SqlitePersistence(path)) for path in glob.glob(shard_file('*'))
+               if path not in {shard_file(i) for i in range(shards)}]
+    if os.path.exists(PERSISTENCE_FILE):
+        sources.append((PERSISTENCE_FILE, SqlitePersistence(PERSISTENCE_FILE)))
+    routes = {}
+    moved = 0
+    for current, store in list(enumerate(stores)) + sources:
+        outgoing = {}
+        for chat_id, blob in store.all_rows():
+            first = first_game(blob)
+            if first is None and isinstance(current, int):
+                # a chat without games, e.g. with all of them in cold storage, stays where it is
+                owner = routes[chat_id] = current
+            else:
+                owner = routes[chat_id] = shard_of(owner_key(chat_id, first), shards)
+            if owner != current:
+                outgoing.setdefault(owner, []).append((chat_id, blob))
+        for owner, rows in outgoing.items():
+            stores[owner].import_rows(rows)
+            stores[owner].import_cold_rows(store.cold_rows(chat_id for chat_id, _ in rows))
+            store.delete_rows(chat_id for chat_id, _ in rows)
+            moved += len(rows)
+    if sources:
+        # turn times of all games are shown from all shard files together, those of dropped files go to shard 0
+        turns = QuantileSketch()
+        for store in [stores[0]] + [store for _, store in sources]:
+            if saved := store.load_stats(FLEET_TURNS):
+                turns.merge(QuantileSketch.from_dict(saved))
+        stores[0].save_stats(FLEET_TURNS, turns.to_dict())
+    for store in stores + [store for _, store in sources]:
+        store.close()
+    logging.info("Rebalanced %d of %d chats over %d shards", moved, len(routes), shards)
+    return routes
+
+
+class Shard:
+    """
+    A worker process. Once an update leaves a chat with its first game owned by another shard,
+    the chat is handed over to that shard through the files, and updates of the chat which
+    still come here are sent back to the front to be routed again. Digest subscriptions are
+    announced to all shards, and turns of a subscriber go to the shard of their private chat.
+    """
+
+    def __init__(self, index, shards, updates: multiprocessing.Queue, outbox: multiprocessing.Queue):
+        self.index = index
+        self.shards = shards
+        self.updates = updates  # from the front: (kind, chat_id, payload), None to stop
+        self.outbox = outbox  # to the front, same form
+        self.away = set()  # chats handed over to other shards
+
+    def owner(self, chat_id, chat_data):
+        games = chat_data.get('GAMES')
+        data = next(iter(games), None) if games else None
+        if data is None:
+            return self.index
+        return shard_of(owner_key(chat_id, (data.host, data.game_id)), self.shards)
+
+    async def bounce(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat = update.effective_chat
+        if chat is None or chat.id not in self.away:
+            return
+        self.outbox.put(('update', chat.id, json.dumps(update.to_dict())))
+        # nothing of the chat is kept here, not even the empty data loaded for this update
+        context.application.persistence.unload(chat.id)
+        raise ApplicationHandlerStop
+
+    async def hand_over(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        import main
+
+        chat = update.effective_chat
+        if chat is None or chat.id in self.away or not context.chat_data:
+            return
+        owner = self.owner(chat.id, context.chat_data)
+        if owner == self.index:
+            return
+        logging.info("Handing chat %s over to shard %d", chat.id, owner)
+        main.leave_chat(chat.id, context.chat_data)
+        context.application.persistence.move_chat(chat.id, context.chat_data, shard_file(owner))
+        context.chat_data.clear()
+        self.away.add(chat.id)
+        self.outbox.put(('moved', chat.id, owner))
+
+    def announce(self, username, user_id):
+        self.outbox.put(('subscribed', None, (self.index, username, user_id)))
+
+    def forward_turn(self, user_id, username, key, entry):
+        self.outbox.put(('turn', user_id, (username, key, entry)))
+
+    async def adopt(self, app: Application, chat_id):
+        import main
+
+        self.away.discard(chat_id)
+        context = app.context_types.context(app, chat_id=chat_id)
+        async with chat_lock(chat_id):
+            app.persistence.unload(chat_id)
+            context.chat_data.clear()
+            await app.persistence.refresh_chat_data(chat_id, context.chat_data)
+            main.resume_chat(app, chat_id, context.chat_data)
+
+    def run(self, log_level):
+        # the front process handles Ctrl+C and tells shards to stop
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        logging.basicConfig(filename=LOG_NAME, format=f'%(asctime)s shard{self.index} %(message)s',
+                            level=log_level)
+        import main
+        import metrics
+        from dispatcher import TokenBucket
+
+        metrics.port += 1 + self.index
+        # all shards send with the same token, together they stay within its flood limit
+        main.dispatcher.global_bucket = TokenBucket(TG_GLOBAL_RATE / self.shards,
+                                                    max(TG_GLOBAL_BURST / self.shards, 1))
+        app = main.build_application(SqlitePersistence(shard_file(self.index), update_interval=30), webhook=True)
+        app.add_handler(TypeHandler(Update, self.bounce), group=-2)
+        app.add_handler(TypeHandler(Update, self.hand_over), group=1)
+        main.digest.announce = self.announce
+        main.digest.forward = self.forward_turn
+        main.shard_files = [shard_file(i) for i in range(self.shards) if i != self.index]
+
+        async def consume():
+            loop = asyncio.get_running_loop()
+            async with running(app):
+                while (message := await loop.run_in_executor(None, self.updates.get)) is not None:
+                    kind, chat_id, payload = message
+                    if kind == 'update':
+                        await app.update_queue.put(Update.de_json(json.loads(payload), app.bot))
+                    elif kind == 'adopt':
+                        await self.adopt(app, chat_id)
+                    elif kind == 'subscribed':
+                        main.digest.subscribe_remote(*payload)
+                    elif kind == 'turn':
+                        main.digest.set_turn(*payload)
+
+        asyncio.run(consume())
+
+
+def run_shard(index, shards, updates: multiprocessing.Queue, outbox: multiprocessing.Queue, log_level):
+    Shard(index, shards, updates, outbox).run(log_level)
+
+
+class Front:
+    def __init__(self, shards):
+        self.shards = shards
+        self.routes = rebalance(shards)
+        ctx = multiprocessing.get_context('spawn')
+        self.queues = [ctx.Queue(UPDATE_QUEUE_SIZE) for _ in range(shards)]
+        self.outbox = ctx.Queue()
+        self.workers = [ctx.Process(target=run_shard, args=(i, shards, q, self.outbox, logging.getLogger().level),
+                                    name=f"shard{i}") for i, q in enumerate(self.queues)]
+        self.relay_task = None
+
+    def shard_for(self, chat_id):
+        if chat_id is None:
+            return 0
+        shard = self.routes.get(chat_id)
+        if shard is None:
+            shard = self.routes[chat_id] = shard_of(owner_key(chat_id), self.shards)
+        return shard
+
+    async def send(self, shard, message):
+        await asyncio.get_running_loop().run_in_executor(None, self.queues[shard].put, message)
+
+    async def route(self, update: Update, _):
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        await self.send(self.shard_for(chat_id), ('update', chat_id, json.dumps(update.to_dict())))
+
+    async def relay(self):
+        """ handles what shards tell the front """
+        loop = asyncio.get_running_loop()
+        while (message := await loop.run_in_executor(None, self.outbox.get)) is not None:
+            kind, chat_id, payload = message
+            if kind == 'moved':
+                # updates routed to the old shard meanwhile come back after this message
+                self.routes[chat_id] = payload
+                await self.send(payload, ('adopt', chat_id, None))
+            elif kind == 'update':
+                await self.send(self.shard_for(chat_id), ('update', chat_id, payload))
+            elif kind == 'subscribed':
+                sender, username, user_id = payload
+                for shard in range(self.shards):
+                    if shard != sender:
+                        await self.send(shard, ('subscribed', None, (username, user_id)))
+            elif kind == 'turn':
+                # chat_id is the subscriber's private chat
+                await self.send(self.shard_for(chat_id), message)
+
+    def start_workers(self):
+        for worker in self.workers:
+            worker.start()
+
+    async def start_relay(self, _=None):
+        self.relay_task = asyncio.create_task(self.relay(), name="shard relay")
+
+    async def stop_workers(self, _=None):
+        for q in self.queues:
+            q.put(None)
+        for worker in self.workers:
+            await asyncio.get_running_loop().run_in_executor(None, worker.join)
+        self.outbox.put(None)
+        if self.relay_task:
+            await self.relay_task
+
+    def build_application(self) -> Application:
+        builder = Application.builder().token(TOKEN).http_version('1.1') \
+            .post_init(self.start_relay).post_shutdown(self.stop_workers)
+        if RUN_MODE == RUN_WEBHOOK:
+            builder.updater(None).update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        else:
+            builder.get_updates_http_version('1.1')
+        app = builder.build()
+        app.add_handler(TypeHandler(Update, self.route))
+        return app
+
+
+def run_sharded(shards):
+    from webhook import run_webhook
+
+    if not glob.glob(shard_file('*')):
+        persistence = SqlitePersistence(PERSISTENCE_FILE)
+        import_pickle(persistence, LEGACY_PERSISTENCE_FILE)
+        persistence.close()
+    front = Front(shards)
+    front.start_workers()
+    app = front.build_application()
+    if RUN_MODE == RUN_WEBHOOK:
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
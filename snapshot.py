@@ -0,0 +1,62 @@
+from typing import NamedTuple
+
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+
+class GameSnapshot(NamedTuple):
+    """ the part of the spectator reply the bot works with """
+    phase: str
+    current_players: tuple  # ((name, timer started at, ms), ...)
+    oceans: int
+    oxygen: int
+    temperature: int
+    player_names: tuple
+    game_age: int
+    undo_count: int
+    generation: int
+    venus: int = None  # venus scale, None without the Venus expansion
+    moon: tuple = None  # (habitat, mining, logistics) rates, None without the Moon expansion
+    venus_required: bool = False  # the game does not end before Venus is terraformed
+    moon_required: bool = False
+
+
+def parse_snapshot(raw) -> GameSnapshot:
+    return make_snapshot(loads(raw))
+
+
+def make_snapshot(reply: dict) -> GameSnapshot:
+    game = reply['game']
+    names = []
+    current = []
+    for player in reply['players']:
+        names.append(player['name'])
+        timer = player['timer']
+        if timer['running']:
+            current.append((player['name'], timer['startedAt']))
+    options = game.get('gameOptions', {})
+    expansions = options.get('expansions', {})
+    moon = game.get('moon')
+    return GameSnapshot(
+        phase=game['phase'],
+        current_players=tuple(current),
+        oceans=game['oceans'],
+        oxygen=game['oxygenLevel'],
+        temperature=game['temperature'],
+        player_names=tuple(names),
+        game_age=game.get('gameAge'),
+        undo_count=game.get('undoCount'),
+        generation=game.get('generation'),
+        venus=game.get('venusScaleLevel') if expansions.get('venus', options.get('venusNextExtension')) else None,
+        moon=(moon['habitatRate'], moon['miningRate'], moon['logisticsRate']) if moon else None,
+        venus_required=bool(options.get('requiresVenusTrackCompletion')),
+        moon_required=bool(options.get('requiresMoonTrackCompletion')),
+    )
+
+
+def get_current_players(snapshot: GameSnapshot):
+    if not snapshot.current_players:
+        raise RuntimeError("Cannot find current player")
+    return snapshot.current_players
@@ -1,39 +1,34 @@
 from telegram.ext import ContextTypes
-from l18n import LK_TF_STATUS, l18n
+from l18n import LK_TF_STATUS, LK_TF_VENUS, LK_TF_MOON, LK_TF_FORECAST, l18n
+from snapshot import GameSnapshot
 
 
 class TerraformingTracker:
-    MAX_OCEANS = 9
-    MAX_OXYGEN = 14
-    MIN_TEMP = -30
-    MAX_TEMP = 8
+    """ the terraforming progress last reported to a chat, progress.py computes it """
+    __slots__ = ('last',)
 
     def __init__(self):
         self.last = 0
 
-    def get_total(self, oceans, oxygen, temp) -> int:
-        """ percentage """
-        return round(
-            (oceans / self.MAX_OCEANS
-             + oxygen / self.MAX_OXYGEN
-             + (temp - self.MIN_TEMP) / (self.MAX_TEMP - self.MIN_TEMP)) / 3 * 100
-        )
+    def __getstate__(self):
+        return {'last': self.last}
 
-    def check(self, reply: dict):
-        game = reply['game']
-        oceans = game['oceans']
-        assert 0 <= oceans <= self.MAX_OCEANS
-        oxygen = game['oxygenLevel']
-        assert 0 <= oxygen <= self.MAX_OXYGEN
-        temp = game['temperature']
-        assert self.MIN_TEMP <= temp <= self.MAX_TEMP
-        current_total = self.get_total(oceans, oxygen, temp)
-        if current_total // 10 > self.last // 10:
-            self.last = current_total
-            return oceans, oxygen, temp
-        else:
-            return False
+    def __setstate__(self, state):
+        self.last = state['last']
 
-    def make_message(self, context: ContextTypes.DEFAULT_TYPE, oceans, oxygen, temp):
-        return l18n(context, LK_TF_STATUS) \
-            .format(self.last, oceans, oxygen, temp)
+    def report(self, percent):
+        """ whether the percentage is over the next 10% threshold, remembered as reported if it is """
+        if percent // 10 > self.last // 10:
+            self.last = percent
+            return True
+        return False
+
+    def make_message(self, context: ContextTypes.DEFAULT_TYPE, snapshot: GameSnapshot, generations_left=None):
+        text = l18n(context, LK_TF_STATUS).format(self.last, snapshot.oceans, snapshot.oxygen, snapshot.temperature)
+        if snapshot.venus is not None:
+            text += l18n(context, LK_TF_VENUS).format(snapshot.venus)
+        if snapshot.moon is not None:
+            text += l18n(context, LK_TF_MOON).format(*snapshot.moon)
+        if generations_left:
+            text += l18n(context, LK_TF_FORECAST).format(generations_left)
+        return text
@@ -0,0 +1,141 @@
+import logging
+import time
+
+from telegram.ext import Application, ContextTypes, JobQueue
+
+import metrics
+from chat_locks import chat_lock
+from config import PASS_CHECK_FREQUENCY
+from constants import PHASE_DRAFTING, PHASE_RESEARCH, PHASE_END, ST_FINISHED, TURN_PASS
+from game_api import game_api, CircuitOpenError
+from game_data import GameData
+
+
+PASS_OPTION_TITLE = "Pass for this generation"
+
+
+class PendingPass:
+    def __init__(self, chat_id, game_data: GameData, username):
+        self.chat_id = chat_id
+        self.game_data = game_data
+        self.username = username
+        self.in_flight = False
+
+    def is_scheduled(self):
+        if self.game_data.state == ST_FINISHED:
+            return False
+        player = self.game_data.player(self.username)
+        return player is not None and player.action == TURN_PASS
+
+
+class TurnMaker:
+    """
+    Makes scheduled turns: watches the player endpoint of every user with a pending /pass
+    and passes for them as soon as their turn comes, checking different players concurrently.
+    Players' actions in GameData stay the source of truth, so turns unscheduled elsewhere are dropped.
+    """
+
+    def __init__(self, on_passed):
+        self.on_passed = on_passed  # async (context, chat_id, game_data, player_name)
+        self.pending = {}  # (chat_id, game_id, username) -> PendingPass
+        self.job = None
+
+    @staticmethod
+    def find_pass_option_index(api_reply):
+        options = api_reply['waitingFor']['options']
+        for i, option in enumerate(options):
+            if option['title'] == PASS_OPTION_TITLE:
+                return i
+        raise RuntimeError("Not found passing option")
+
+    @staticmethod
+    def is_pass_turn(api_reply):
+        if api_reply['game']['phase'] in (PHASE_DRAFTING, PHASE_RESEARCH):
+            return False
+        waiting_for = api_reply.get('waitingFor')
+        return bool(waiting_for) and any(o.get('title') == PASS_OPTION_TITLE for o in waiting_for.get('options', []))
+
+    def schedule(self, job_queue: JobQueue, chat_id, game_data: GameData, username):
+        self.pending[(chat_id, game_data.game_id, username)] = PendingPass(chat_id, game_data, username)
+        if self.job is None:
+            self.job = job_queue.run_repeating(self.tick, PASS_CHECK_FREQUENCY, name="turn maker")
+
+    def resume(self, job_queue: JobQueue, chat_id, game_data: GameData):
+        for player in game_data.scheduled():
+            if player.action == TURN_PASS:
+                self.schedule(job_queue, chat_id, game_data, player.username)
+
+    def cancel(self, chat_id, game_data: GameData, username):
+        self.pending.pop((chat_id, game_data.game_id, username), None)
+
+    def cancel_game(self, chat_id, game_data: GameData):
+        for username in game_data.players:
+            self.cancel(chat_id, game_data, username)
+
+    def cancel_chat(self, chat_id):
+        for key in [key for key in self.pending if key[0] == chat_id]:
+            self.pending.pop(key)
+
+    def is_pending(self, game_data: GameData, player_name):
+        player = game_data.player_by_name(player_name)
+        return player is not None and player.action == TURN_PASS
+
+    async def tick(self, context: ContextTypes.DEFAULT_TYPE):
+        for key, pending in list(self.pending.items()):
+            if not pending.is_scheduled():
+                self.pending.pop(key)
+            elif not pending.in_flight:
+                pending.in_flight = True
+                context.application.create_task(self.try_pass(context.application, pending),
+                                                name="pass {} {} {}".format(*key))
+
+    async def passed(self, application: Application, chat_id, data: GameData, username):
+        """ bookkeeping once the user's turn has been passed """
+        player = data.player(username)
+        player.action = None
+        self.cancel(chat_id, data, username)
+        context = application.context_types.context(application, chat_id=chat_id)
+        await self.on_passed(context, chat_id, data, player.name)
+        application.mark_data_for_update_persistence(chat_ids=chat_id)
+
+    async def try_pass(self, application: Application, pending: PendingPass):
+        try:
+            data = pending.game_data
+            player = data.player(pending.username)
+            player_name, player_id = player.name, player.player_id
+            reply = await game_api.get_json(data.host, 'player', player_id)
+            if reply['game']['phase'] == PHASE_END:
+                # the poller may not have seen the end yet
+                self.cancel(pending.chat_id, data, pending.username)
+                return
+            if not self.is_pass_turn(reply):
+                return
+            pass_idx = self.find_pass_option_index(reply)
+            # a /nopass sent meanwhile is either handled before the pass or finds it done
+            async with chat_lock(pending.chat_id):
+                key = (pending.chat_id, data.game_id, pending.username)
+                # cancelled meanwhile, e.g. the game is no longer tracked here
+                if self.pending.get(key) is not pending or not pending.is_scheduled():
+                    return
+                reply_post = await game_api.post_input(data.host, player_id, {
+                    'type': 'or',
+                    'index': pass_idx,
+                    'response': {
+                        'type': 'option'
+                    }
+                })
+                if reply_post.status_code != 200:
+                    logging.error("Passing failed for %s: %s", player_name, reply_post.text)
+                    return
+                timer = reply.get('thisPlayer', {}).get('timer', {})
+                if timer.get('running'):
+                    latency = time.time() - timer['startedAt'] / 1000
+                    metrics.observe('pass_latency_seconds', latency)
+                    logging.info("Passed for %s, %.1f s after the turn started", player_name, latency)
+                await self.passed(application, pending.chat_id, data, pending.username)
+        except CircuitOpenError:
+            pass
+        except Exception:
+            logging.exception("Failed to check pass for %s in chat %s", pending.username, pending.chat_id)
+        finally:
+            pending.in_flight = False
@@ -0,0 +1,116 @@
+import math
+
+
+RELATIVE_ACCURACY = 0.05
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+MIN_SECONDS = 1
+MAX_BUCKETS = 128
+
+
+class QuantileSketch:
+    """
+    Streaming quantiles in the manner of DDSketch: values are counted in logarithmic buckets, so any
+    quantile is off by at most RELATIVE_ACCURACY. Beyond MAX_BUCKETS the lowest buckets are merged.
+    """
+    __slots__ = ('buckets', 'count', 'sum')
+
+    def __init__(self):
+        self.buckets = {}  # index -> count, bucket i holds values in (GAMMA^(i-1), GAMMA^i]
+        self.count = 0
+        self.sum = 0
+
+    def add(self, value, count=1):
+        index = math.ceil(math.log(max(value, MIN_SECONDS)) / LOG_GAMMA)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        self.sum += value * count
+        if len(self.buckets) > MAX_BUCKETS:
+            lowest, second = sorted(self.buckets)[:2]
+            self.buckets[second] += self.buckets.pop(lowest)
+
+    def merge(self, other: 'QuantileSketch'):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        while len(self.buckets) > MAX_BUCKETS:
+            lowest, second = sorted(self.buckets)[:2]
+            self.buckets[second] += self.buckets.pop(lowest)
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+    def quantile(self, q):
+        if not self.count:
+            return 0
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return 2 * GAMMA ** index / (GAMMA + 1)
+        return 0
+
+    def to_dict(self):
+        return {'buckets': sorted(self.buckets.items()), 'sum': self.sum}
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls()
+        sketch.buckets = dict(map(tuple, d['buckets']))
+        sketch.count = sum(sketch.buckets.values())
+        sketch.sum = d['sum']
+        return sketch
+
+
+class TurnStats:
+    """ turn durations of every player of a game, in seconds """
+    __slots__ = ('players',)
+
+    def __init__(self):
+        self.players = {}  # in-game name -> QuantileSketch
+
+    def observe(self, name, seconds):
+        sketch = self.players.get(name)
+        if sketch is None:
+            sketch = self.players[name] = QuantileSketch()
+        sketch.add(seconds)
+
+    def total(self) -> QuantileSketch:
+        total = QuantileSketch()
+        for sketch in self.players.values():
+            total.merge(sketch)
+        return total
+
+    def to_dict(self):
+        return {name: sketch.to_dict() for name, sketch in self.players.items()}
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls()
+        stats.players = {name: QuantileSketch.from_dict(sketch) for name, sketch in d.items()}
+        return stats
+
+
+def finished_turns(previous, current, now):
+    """
+    yields (name, seconds) for the turns of previous current players which are over in current;
+    a turn ends when the next one starts, or now if none did
+    """
+    started_next = max((started for _, started in current), default=0)
+    for name, started in previous:
+        if (name, started) in current:
+            continue
+        ended = started_next / 1000 if started_next > started else now
+        yield name, max(ended - started / 1000, 0)
+
+
+def format_duration(seconds):
+    seconds = round(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    minutes = seconds // 60
+    if minutes < 60:
+        return f"{minutes}m"
+    return f"{minutes // 60}h{minutes % 60:02d}m"
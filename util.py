@@ -15,6 +15,3 @@ def try_parse_game_url(text):
     except:
         pass
 
-
-def build_api_url(host, page, id):
-    return "http://{}/api/{}?id={}".format(host, page, id)
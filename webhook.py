@@ -0,0 +1,83 @@
+"""
+Webhook mode: Telegram posts updates to a local HTTP endpoint instead of the bot long polling them.
+
+Recorded updates (a JSON list or one update per line) can be replayed against a running bot:
+    python webhook.py updates.json
+"""
+import asyncio
+import hmac
+import json
+import logging
+import signal
+import sys
+from http import HTTPStatus
+
+from telegram import Update
+from telegram.ext import Application
+
+from config import WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET
+from http_server import Request, serve
+from lifecycle import running
+
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+
+def make_handler(app: Application):
+    async def handle_update(request: Request):
+        if request.path != WEBHOOK_PATH or request.method != 'POST':
+            return HTTPStatus.NOT_FOUND, 'text/plain', b''
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), WEBHOOK_SECRET):
+            return HTTPStatus.FORBIDDEN, 'text/plain', b''
+        try:
+            update = Update.de_json(json.loads(request.body), app.bot)
+        except ValueError:
+            return HTTPStatus.BAD_REQUEST, 'text/plain', b''
+        try:
+            app.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram redelivers the update later
+            logging.warning("Update queue is full, rejecting update %s", update.update_id)
+            return HTTPStatus.SERVICE_UNAVAILABLE, 'text/plain', b''
+        return HTTPStatus.OK, 'text/plain', b''
+    return handle_update
+
+
+async def run_webhook(app: Application):
+    """ like Application.run_webhook, but with our own server and bounded update queue """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with running(app):
+        server = await serve(make_handler(app), WEBHOOK_LISTEN, WEBHOOK_PORT)
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+        logging.info("Listening for updates on %s:%s%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        try:
+            await stop.wait()
+        finally:
+            server.close()
+
+
+async def post_updates(path):
+    import httpx
+
+    with open(path) as f:
+        text = f.read()
+    try:
+        updates = json.loads(text)
+    except ValueError:
+        updates = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(updates, dict):
+        updates = [updates]
+    url = f"http://{WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+    async with httpx.AsyncClient() as client:
+        for update in updates:
+            reply = await client.post(url, json=update, headers={SECRET_HEADER: WEBHOOK_SECRET})
+            print(update.get('update_id'), reply.status_code)
+
+
+if __name__ == "__main__":
+    asyncio.run(post_updates(sys.argv[1]))